@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+* bench_box_cache.py
+* Further licensing information: see LICENSE.
+
+Times the crypto half of an authenticated request (publish/unpublish):
+building the shared-key Box and opening the payload, with and without
+CryptoCore's Box cache.
+
+    python3 misc/bench_box_cache.py [requests] [distinct clients]
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import nacl.public as public
+import nacl.encoding
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+os.chdir(tempfile.mkdtemp())  # CryptoCore writes its key file to the cwd
+import main
+
+def payloads(server_key, requests, clients):
+    keys = [public.PrivateKey.generate() for _ in range(clients)]
+    out = []
+    for i in range(requests):
+        key = keys[i % clients]
+        nonce = os.urandom(24)
+        text = json.dumps({"public_key": "00" * 32, "timestamp": 0})
+        box = public.Box(key, server_key)
+        out.append((key.public_key.encode(nacl.encoding.RawEncoder), nonce,
+                    box.encrypt(text.encode("utf8"), nonce).ciphertext))
+    return out
+
+def run(open_box, work):
+    start = time.perf_counter()
+    for client, nonce, ciphertext in work:
+        open_box(client).decrypt(ciphertext, nonce)
+    return (time.perf_counter() - start) / len(work) * 1e6
+
+def main_():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    core = main.CryptoCore()
+    work = payloads(core.pkey.public_key, requests, clients)
+
+    uncached = run(lambda c: public.Box(core.pkey, public.PublicKey(c)), work)
+    cached = run(core.box_for, work)
+    print("{0} requests from {1} clients".format(requests, clients))
+    print("new Box per request: {0:8.2f} us/request".format(uncached))
+    print("cached Box:          {0:8.2f} us/request".format(cached))
+    print("box cache: {0}".format(core.box_stats()))
+
+if __name__ == "__main__":
+    main_()
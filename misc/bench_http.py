@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+* bench_http.py
+* Further licensing information: see LICENSE.
+
+End-to-end load test. Seeds a throwaway SQLite database, starts
+src/main.py against it in sandbox mode, then drives each /api action and
+web route in turn from several client processes and reports throughput
+and latency percentiles as JSON.
+
+    python3 misc/bench_http.py [--rows N] [--duration S] [--concurrency C]
+                               [--workers W] [-o run.json]
+    python3 misc/bench_http.py ... --compare previous.json
+
+Publishes use real crypto_box envelopes from one key per client thread.
+"""
+import os
+import sys
+import json
+import time
+import base64
+import random
+import shlex
+import signal
+import argparse
+import datetime
+import tempfile
+import platform
+import subprocess
+import http.client
+import multiprocessing
+import threading
+import nacl.public as public
+import nacl.encoding
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+import database
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), "../src"))
+SCENARIOS = ("lookup", "rlookup", "search", "publish", "status", "friends",
+             "profile", "barcode")
+SAMPLE = 2000
+
+def checksum(hex_id):
+    check = [0, 0]
+    for ind, byte in enumerate(bytes.fromhex(hex_id)):
+        check[ind % 2] ^= byte
+    return "".join("{0:02X}".format(byte) for byte in check)
+
+def public_key(i):
+    return "{0:064X}".format((i * 0x9E3779B97F4A7C15) % (1 << 256))
+
+def seed(url, rows):
+    database.Database(url, should_echo=0).create_schema()
+    engine = database.sqlalchemy.create_engine(url)
+    start = datetime.datetime(2014, 4, 1)
+    table = database.User.__table__
+    for base in range(0, rows, 5000):
+        batch = []
+        for i in range(base, min(rows, base + 5000)):
+            key, pin = public_key(i), "{0:08X}".format(i)
+            batch.append({
+                "name": "u{0}".format(i), "bio": "bio of u{0}".format(i),
+                "public_key": key, "pin": pin, "checksum": checksum(key + pin),
+                "privacy": 1 if i % 5 else 0, "sig": "", "password": b"x",
+                "timestamp": start + datetime.timedelta(seconds=i * 37),
+            })
+        with engine.begin() as conn:
+            conn.execute(table.insert(), batch)
+    engine.dispose()
+
+def start_server(args, directory):
+    cfg = {
+        "database_url": "sqlite:///" + os.path.join(directory, "bench.db"),
+        "registration_domain": "localhost",
+        "server_port": args.port,
+        "server_addr": "127.0.0.1",
+        "pid_file": os.path.join(directory, "pidfile"),
+        "secure_mode": 0,
+        "is_proxied": 0,
+        "templates": "tox",
+        "findfriends_enabled": 1,
+        "qr_store": os.path.join(directory, "qr_store"),
+        "number_of_workers": args.workers,
+        "sandbox": 1,
+    }
+    with open(os.path.join(directory, "config.json"), "w") as config_file:
+        json.dump(cfg, config_file)
+    log = open(os.path.join(directory, "server.log"), "w")
+    command = shlex.split(args.server) + [os.path.join(SRC, "main.py")]
+    server = subprocess.Popen(command, cwd=directory, stdout=log,
+                              stderr=subprocess.STDOUT)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if server.poll() is not None:
+            sys.exit("server exited, see " + log.name)
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", args.port)
+            conn.request("GET", "/pk")
+            key = json.loads(conn.getresponse().read().decode("utf8"))["key"]
+            conn.close()
+            return server, key
+        except (OSError, ValueError, KeyError):
+            time.sleep(0.2)
+    server.terminate()
+    sys.exit("server did not come up, see " + log.name)
+
+class Client(object):
+    """Builds the requests for one scenario on one client thread."""
+    def __init__(self, scenario, ctx, rng):
+        self.scenario = scenario
+        self.ctx = ctx
+        self.rng = rng
+        if scenario == "publish":
+            self.key = public.PrivateKey.generate()
+            self.box = public.Box(self.key, public.PublicKey(
+                ctx["server_key"], nacl.encoding.HexEncoder))
+            pk = self.key.public_key.encode(nacl.encoding.HexEncoder)
+            self.pk = pk.decode("ascii").upper()
+            self.name = "bench-{0}".format(self.pk[:16].lower())
+            self.tox_id = self.pk + "00000000"
+            self.tox_id += checksum(self.tox_id)
+
+    def api(self, envelope):
+        return "POST", "/api", json.dumps(envelope)
+
+    def request(self):
+        rng, ctx = self.rng, self.ctx
+        i = rng.randrange(ctx["rows"])
+        if self.scenario == "lookup":
+            return self.api({"action": 3, "name": "u{0}".format(i)})
+        elif self.scenario == "rlookup":
+            return self.api({"action": 5, "id": public_key(i)})
+        elif self.scenario == "search":
+            return self.api({"action": 6, "name": "u{0}".format(i)[:4],
+                             "page": 0})
+        elif self.scenario == "status":
+            return self.api({"action": 4})
+        elif self.scenario == "publish":
+            payload = json.dumps({
+                "tox_id": self.tox_id, "name": self.name, "privacy": 1,
+                "bio": "bench {0}".format(rng.random()),
+                "timestamp": int(time.time()),
+            }).encode("utf8")
+            nonce = os.urandom(24)
+            encrypted = self.box.encrypt(payload, nonce).ciphertext
+            return self.api({
+                "action": 1, "public_key": self.pk,
+                "nonce": base64.b64encode(nonce).decode("ascii"),
+                "encrypted": base64.b64encode(encrypted).decode("ascii"),
+            })
+        elif self.scenario == "friends":
+            return "GET", "/friends/{0}".format(rng.randrange(ctx["pages"])), None
+        elif self.scenario == "profile":
+            return "GET", "/u/u{0}".format(i), None
+        elif self.scenario == "barcode":
+            # a small working set, as with real profile views
+            return "GET", "/barcode/u{0}.svg".format(i % SAMPLE), None
+
+def drive(job):
+    """One client process: threads hammering one scenario until the
+       deadline. Returns (latencies in seconds, errors)."""
+    scenario, ctx, threads, deadline, seed_value = job
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+
+    def run(n):
+        client = Client(scenario, ctx, random.Random(seed_value * 1000 + n))
+        conn = http.client.HTTPConnection("127.0.0.1", ctx["port"])
+        mine, failed = [], 0
+        while time.time() < deadline:
+            method, path, body = client.request()
+            start = time.perf_counter()
+            try:
+                conn.request(method, path, body)
+                response = conn.getresponse()
+                response.read()
+                ok = response.status == 200
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", ctx["port"])
+                ok = False
+            mine.append(time.perf_counter() - start)
+            failed += not ok
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    workers = [threading.Thread(target=run, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return latencies, errors[0]
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def run_scenario(pool, scenario, ctx, args):
+    processes = min(args.processes, args.concurrency)
+    share = [args.concurrency // processes + (n < args.concurrency % processes)
+             for n in range(processes)]
+    start = time.time()
+    deadline = start + args.duration
+    jobs = [(scenario, ctx, threads, deadline, n)
+            for n, threads in enumerate(share)]
+    latencies, errors = [], 0
+    for part, failed in pool.map(drive, jobs):
+        latencies.extend(part)
+        errors += failed
+    elapsed = time.time() - start
+    latencies.sort()
+    if not latencies:
+        return {"requests": 0, "errors": errors}
+    ms = lambda seconds: round(seconds * 1000, 3)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": round(len(latencies) / elapsed, 1),
+        "mean_ms": ms(sum(latencies) / len(latencies)),
+        "p50_ms": ms(percentile(latencies, 0.50)),
+        "p95_ms": ms(percentile(latencies, 0.95)),
+        "p99_ms": ms(percentile(latencies, 0.99)),
+        "max_ms": ms(latencies[-1]),
+    }
+
+def compare(previous, current):
+    print("{0:10} {1:>24} {2:>24} {3:>24}".format(
+        "", "throughput (req/s)", "p50 (ms)", "p99 (ms)"), file=sys.stderr)
+    for scenario, now in current["results"].items():
+        before = previous.get("results", {}).get(scenario)
+        cells = []
+        for key in ("throughput", "p50_ms", "p99_ms"):
+            if not before or key not in before or key not in now:
+                cells.append("{0:>24}".format(now.get(key, "-")))
+                continue
+            change = ((now[key] - before[key]) / before[key] * 100
+                      if before[key] else 0)
+            cells.append("{0:>10} -> {1:>8} {2:+4.0f}%".format(
+                before[key], now[key], change))
+        print("{0:10} {1}".format(scenario, " ".join(cells)), file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--processes", type=int, default=4,
+                        help="client processes the concurrency is spread over")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number_of_workers for the server")
+    parser.add_argument("--port", type=int, default=18765)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--server", default=sys.executable,
+                        help="command that runs main.py")
+    parser.add_argument("-o", "--output", default="-")
+    parser.add_argument("--compare")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="toxme-bench-")
+    seed("sqlite:///" + os.path.join(directory, "bench.db"), args.rows)
+    server, server_key = start_server(args, directory)
+    ctx = {
+        "port": args.port, "rows": args.rows, "server_key": server_key,
+        # searchable users only: every fifth row is private
+        "pages": max(1, min(50, args.rows * 4 // 5 // 30)),
+    }
+    results = {}
+    try:
+        with multiprocessing.get_context("fork").Pool(args.processes) as pool:
+            for scenario in args.scenarios.split(","):
+                results[scenario] = run_scenario(pool, scenario, ctx, args)
+                print("{0:10} {1}".format(scenario, results[scenario]),
+                      file=sys.stderr)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+    report = {
+        "meta": {
+            "rows": args.rows,
+            "duration": args.duration,
+            "concurrency": args.concurrency,
+            "workers": args.workers,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "when": datetime.datetime.utcnow().isoformat() + "Z",
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(json.load(previous), report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+* bench_queries.py
+* Further licensing information: see LICENSE.
+
+Seeds a throwaway SQLite database, then times the directory queries and
+prints their query plans before and after the schema migrations.
+
+    python3 misc/bench_queries.py [rows]
+"""
+import os
+import sys
+import time
+import datetime
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+import database
+import migrations
+
+ROUNDS = 20
+
+PLANS = [
+    ("friends page", "SELECT * FROM records WHERE privacy > 0 "
+                     "ORDER BY timestamp DESC, user_id DESC LIMIT 30"),
+    ("friends after cursor", "SELECT * FROM records WHERE privacy > 0 AND "
+                             "(timestamp < '2015-01-01' OR (timestamp = "
+                             "'2015-01-01' AND user_id < 500)) ORDER BY "
+                             "timestamp DESC, user_id DESC LIMIT 30"),
+    ("search page", "SELECT * FROM records WHERE name IN ('u1', 'u2') "
+                    "AND privacy > 0 ORDER BY name"),
+    ("count searchable", "SELECT count(*) FROM records WHERE privacy > 0"),
+    ("count users", "SELECT count(*) FROM records"),
+]
+
+def seed(engine, rows):
+    start = datetime.datetime(2014, 4, 1)
+    batch = []
+    with engine.begin() as conn:
+        for i in range(rows):
+            batch.append({
+                "name": "u{0}".format(i), "bio": "", "checksum": "0000",
+                "public_key": "{0:064X}".format(i), "pin": "00000000",
+                "privacy": 1 if i % 5 else 0, "sig": "", "password": b"x",
+                "timestamp": start + datetime.timedelta(seconds=i * 37),
+            })
+            if len(batch) == 5000:
+                conn.execute(database.User.__table__.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(database.User.__table__.insert(), batch)
+
+def timed(fn):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        fn()
+    return (time.perf_counter() - start) / ROUNDS * 1000
+
+def measure(db, engine):
+    with engine.connect() as conn:
+        plans = {label: " / ".join(row[-1] for row in
+                                   conn.execute("EXPLAIN QUERY PLAN " + sql))
+                 for label, sql in PLANS}
+
+    def page(num):
+        db.page_bounds = {}
+        sess, _ = db.get_page_ig(num, 30)
+        sess.close()
+
+    def search():
+        db.search_users("u12", 30, 0)
+
+    def count_searchable():
+        sess = db.gs()
+        sess.query(database.User).filter(database.User.privacy > 0).count()
+        sess.close()
+
+    timings = {
+        "friends page 0": timed(lambda: page(0)),
+        "friends page 200 (cold bounds)": timed(lambda: page(200)),
+        "search 'u12'": timed(search),
+        "count searchable": timed(count_searchable),
+        "count users": timed(db.count_users_ig),
+    }
+    return plans, timings
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    directory = tempfile.mkdtemp()
+    url = "sqlite:///" + os.path.join(directory, "bench.db")
+
+    db = database.Database(url, should_echo=0)
+    db.late_init()
+    seed(db.dbc, rows)
+    db.rebuild_search_index()
+    before = measure(db, db.dbc)
+    migrations.upgrade(db.dbc)
+    db.dbc.execute("ANALYZE")
+    after = measure(db, db.dbc)
+
+    print("{0} rows, mean of {1} rounds\n".format(rows, ROUNDS))
+    for label, _ in PLANS:
+        print(label)
+        print("  before: " + before[0][label])
+        print("  after:  " + after[0][label])
+    print()
+    for label in before[1]:
+        print("{0:32} {1:9.3f} ms -> {2:9.3f} ms".format(
+            label, before[1][label], after[1][label]))
+
+if __name__ == "__main__":
+    main()
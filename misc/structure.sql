@@ -15,4 +15,23 @@ CREATE TABLE records (
 	UNIQUE (name), 
 	UNIQUE (public_key)
 );
+CREATE TABLE record_events (
+	event_id INTEGER NOT NULL, 
+	origin VARCHAR, 
+	name VARCHAR, 
+	public_key VARCHAR, 
+	timestamp DATETIME, 
+	PRIMARY KEY (event_id)
+);
+CREATE TABLE schema_version (
+	version INTEGER NOT NULL, 
+	description VARCHAR, 
+	applied DATETIME, 
+	PRIMARY KEY (version)
+);
+CREATE INDEX ix_records_listing ON records (timestamp, user_id) WHERE privacy > 0;
+CREATE INDEX ix_records_privacy ON records (privacy);
+CREATE INDEX ix_record_events_timestamp ON record_events (timestamp);
+INSERT INTO schema_version VALUES(1,'index the /friends listing and searchable counts',CURRENT_TIMESTAMP);
+INSERT INTO schema_version VALUES(2,'index record_events for pruning',CURRENT_TIMESTAMP);
 COMMIT;
@@ -2,11 +2,28 @@ import qrcode
 import qrcode.image.svg
 import xml.etree.ElementTree as ET
 import io
+import os
+import sys
+import json
+import hashlib
+import logging
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
 
-MAX_QR_CACHE_ENTRIES = 256
+import cache
+import tracing
+
+LOGGER = logging.getLogger("toxme")
+
+# Rendered SVGs are ~25KB each; bound the cache by their total size.
+MAX_QR_CACHE_BYTES = 4 * 1024 * 1024
+# Bump when the rendering changes so clients drop their old copies.
+QR_RENDER_VERSION = 1
+# Threads serving cache misses (a disk read, or a render when not stored).
+QR_READ_THREADS = 2
 
 class QRImage(qrcode.image.svg.SvgPathFillImage):
-    YUU_CACHE = {}
+    YUU_CACHE = cache.LRUCache(MAX_QR_CACHE_BYTES, weigh=len)
     QR_PATH_STYLE = "fill:#000;fill-opacity:1;fill-rule:nonzero;stroke:none"
     BACKGROUND_COLOUR = "rgba(255,255,255,0.9)"
 
@@ -40,13 +57,118 @@ class QRImage(qrcode.image.svg.SvgPathFillImage):
         svg.save(stream)
         stream.seek(0)
         data = stream.read()
-        if len(cls.YUU_CACHE) > MAX_QR_CACHE_ENTRIES:
-            cls.YUU_CACHE.popitem()
-        cls.YUU_CACHE[uri] = data
+        cls.YUU_CACHE.put(uri, data)
         return data
 
+    @staticmethod
+    def _uri(address):
+        return "".join(("tox:", address)).lower()
+
+    @classmethod
+    def digest(cls, address):
+        """Content address of the QR code for address: it only changes
+           when the Tox ID or the rendering does."""
+        text = "{0}:{1}".format(QR_RENDER_VERSION, cls._uri(address))
+        return hashlib.sha1(text.encode("utf8")).hexdigest()
+
+    @classmethod
+    def etag(cls, address):
+        """A strong validator for the QR code of address, computed
+           without rendering it."""
+        return '"{0}"'.format(cls.digest(address))
+
     @classmethod
     def get(cls, address):
-        text = "".join(("tox:", address)).lower()
-        return cls.YUU_CACHE.get(text, cls._generate(text))
-        
+        text = cls._uri(address)
+        data = cls.YUU_CACHE.get(text)
+        return data if data is not cache.MISS else cls._generate(text)
+
+class QRStore(object):
+    """Rendered QR codes on disk, named by QRImage.digest() so a file
+       never needs invalidating: a new Tox ID simply has a new name."""
+    def __init__(self, root):
+        self.root = root
+        self.executor = None
+        self.readers = None
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest[:2], digest + ".svg")
+
+    def load(self, address):
+        try:
+            with open(self._path(QRImage.digest(address)), "rb") as svg:
+                return svg.read()
+        except IOError:
+            return None
+
+    def save(self, address, data):
+        path = self._path(QRImage.digest(address))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write aside and rename so readers never see a partial file
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as svg:
+            svg.write(data)
+        os.rename(temp, path)
+
+    def render(self, address):
+        """Render address if it isn't stored yet. Returns the SVG."""
+        data = self.load(address)
+        if data is None:
+            data = QRImage.get(address)
+            self.save(address, data)
+        return data
+
+    def _fetch(self, address):
+        data = self.load(address)
+        if data is None:
+            data = QRImage.get(address)
+            # an unwritable store only costs us the next render
+            try:
+                self.save(address, data)
+            except (IOError, OSError) as e:
+                LOGGER.warn("could not store QR code: {0}".format(e))
+        QRImage.YUU_CACHE.put(QRImage._uri(address), data)
+        return data
+
+    def get(self, address):
+        """A Future for the SVG of address. Misses are read (or rendered)
+           on the reader threads, never on the caller's."""
+        data = QRImage.YUU_CACHE.get(QRImage._uri(address))
+        if data is not cache.MISS:
+            future = Future()
+            future.set_result(data)
+            return future
+        if self.readers is None:
+            self.readers = ThreadPoolExecutor(max_workers=QR_READ_THREADS)
+        return self.readers.submit(tracing.bind(self._fetch, "qr"), address)
+
+    def _render_logged(self, address):
+        try:
+            self.render(address)
+        except (IOError, OSError) as e:
+            LOGGER.warn("could not store QR code: {0}".format(e))
+
+    def schedule(self, address):
+        """Render address in the background, off the request path."""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        self.executor.submit(self._render_logged, address)
+
+def prewarm(store, local_store):
+    """Render every record in local_store into store."""
+    count = 0
+    for user in local_store.iterate_all_users():
+        store.render(user.tox_id())
+        count += 1
+    return count
+
+if __name__ == "__main__":
+    import database
+
+    with open("config.json", "r") as config_file:
+        cfg = json.load(config_file)
+    local_store = database.Database(cfg["database_url"], should_echo=0)
+    local_store.late_init()
+    store = QRStore(cfg.get("qr_store", "qr_store"))
+    print("Rendered {0} QR codes.".format(prewarm(store, local_store)))
+    sys.exit()
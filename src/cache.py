@@ -0,0 +1,206 @@
+"""
+* cache.py
+* Further licensing information: see LICENSE.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+"""
+Module summary: bounded in-memory caches with hit/miss accounting.
+"""
+
+# Returned by get() when a key is absent, since None is a valid value.
+MISS = object()
+
+class LRUCache(object):
+    """Least-recently-used cache bounded by total weight.
+       Without weigh= every entry weighs 1, so capacity is an entry count.
+       With ttl= entries expire that many seconds after insertion."""
+    def __init__(self, capacity, weigh=None, ttl=None):
+        self.capacity = capacity
+        self.weigh = weigh
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.peek(key) is not MISS
+
+    def _expired(self, expires):
+        return expires is not None and expires < time.time()
+
+    def _remove(self, key):
+        value, weight, expires = self.entries.pop(key)
+        self.weight -= weight
+        return value
+
+    def peek(self, key, default=MISS):
+        """Like get(), but neither touches recency nor counts."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or self._expired(entry[2]):
+                return default
+            return entry[0]
+
+    def get(self, key, default=MISS):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self._expired(entry[2]):
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """Insert value and return the list of (key, value) pairs evicted
+           to make room for it."""
+        weight = self.weigh(value) if self.weigh else 1
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if weight > self.capacity:
+                return evicted
+            self.entries[key] = (value, weight, expires)
+            self.weight += weight
+            while self.weight > self.capacity:
+                old_key = next(iter(self.entries))
+                evicted.append((old_key, self._remove(old_key)))
+                self.evictions += 1
+        return evicted
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            return self._remove(key)
+
+    def discard(self, key):
+        self.pop(key)
+
+    def pop_oldest(self):
+        """Remove and return the least recently used (key, value)."""
+        with self.lock:
+            key = next(iter(self.entries))
+            return key, self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.weight = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "weight": self.weight,
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+class SegmentedCache(object):
+    """Segmented LRU with a separate, TTL-bound store for negative entries.
+
+       New keys land in the probation segment and only move to the
+       protected segment when they are read again, so a one-off scan can
+       churn probation but never displaces the hot set. get() returns None
+       for a cached negative and MISS when nothing is known about a key."""
+    def __init__(self, capacity, protected_share=0.8, negative_capacity=None,
+                 negative_ttl=60):
+        protected = max(1, int(capacity * protected_share))
+        self.lock = threading.RLock()
+        self.protected = LRUCache(protected)
+        self.probation = LRUCache(max(1, capacity - protected))
+        self.negative = LRUCache(negative_capacity or capacity,
+                                 ttl=negative_ttl)
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+
+    def __len__(self):
+        return len(self.protected) + len(self.probation)
+
+    def peek(self, key, default=MISS):
+        with self.lock:
+            value = self.protected.peek(key)
+            if value is MISS:
+                value = self.probation.peek(key)
+            if value is MISS:
+                value = None if key in self.negative else default
+            return value
+
+    def get(self, key, default=MISS):
+        with self.lock:
+            value = self.protected.get(key)
+            if value is MISS:
+                value = self.probation.pop(key, MISS)
+                if value is not MISS:
+                    self._promote(key, value)
+            if value is not MISS:
+                self.hits += 1
+                return value
+            if key in self.negative:
+                self.negative_hits += 1
+                return None
+            self.misses += 1
+            return default
+
+    def _promote(self, key, value):
+        # protected overflow is demoted back to probation, not dropped
+        for old_key, old_value in self.protected.put(key, value):
+            self.probation.put(old_key, old_value)
+
+    def put(self, key, value):
+        with self.lock:
+            self.negative.discard(key)
+            if self.protected.peek(key) is not MISS:
+                self.protected.put(key, value)
+            else:
+                self.probation.put(key, value)
+
+    def put_negative(self, key):
+        with self.lock:
+            self.protected.discard(key)
+            self.probation.discard(key)
+            self.negative.put(key, None)
+
+    def discard(self, key):
+        with self.lock:
+            self.protected.discard(key)
+            self.probation.discard(key)
+            self.negative.discard(key)
+
+    def clear(self):
+        with self.lock:
+            self.protected.clear()
+            self.probation.clear()
+            self.negative.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self),
+                "protected": len(self.protected),
+                "probation": len(self.probation),
+                "negative": len(self.negative),
+                "hits": self.hits,
+                "misses": self.misses,
+                "negative_hits": self.negative_hits,
+                "evictions": self.probation.evictions,
+                "negative_evictions": self.negative.evictions,
+            }
@@ -0,0 +1,190 @@
+"""
+* crypto_pool.py
+* Further licensing information: see LICENSE.
+"""
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import tornado.ioloop
+
+import cache
+import tracing
+
+"""
+Module summary: runs the CPU-bound crypto on the request path (record
+and memorabilia signatures, Box decryption, password hashing) in worker
+processes, so a burst of publishes doesn't stall the IOLoop for every
+lookup sharing the process.
+
+Calls made during one IOLoop iteration are sent to a worker together, up
+to BATCH_LIMIT per batch, so the IPC cost is paid once per batch rather
+than once per call.
+"""
+
+BATCH_LIMIT = 32
+
+# set in each worker process by _init_worker
+CORE = None
+
+def _init_worker(crypto_core, sockets):
+    """Runs once in each worker. The keys are already in memory (the pool
+       forks), but the Box cache may have been forked with its lock held
+       by another thread, so it is replaced. The listening sockets are
+       closed so a restarted server can bind them again right away."""
+    global CORE
+    for sock in sockets:
+        sock.close()
+    crypto_core.box_cache = cache.LRUCache(crypto_core.box_cache.capacity)
+    CORE = crypto_core
+
+    parent = os.getppid()
+    def check_parent():
+        while os.getppid() == parent:
+            time.sleep(1)
+        os._exit(0)
+    threading.Thread(target=check_parent, daemon=True).start()
+
+def _run_batch(jobs):
+    """Runs [(method, args)] against CORE. Returns [(ok, result)], along
+       with this worker's pid and Box cache stats."""
+    results = []
+    for method, args in jobs:
+        try:
+            results.append((1, getattr(CORE, method)(*args)))
+        except Exception as e:
+            results.append((0, e))
+    return results, (os.getpid(), CORE.box_cache.stats())
+
+def _noop():
+    return None
+
+class CryptoPool(object):
+    """Awaitable front end to the CryptoCore methods. With processes=0 the
+       calls run inline and return completed futures."""
+    def __init__(self, crypto_core, processes, sockets=()):
+        self.core = crypto_core
+        self.lock = threading.Lock()
+        self.queue = []
+        self.ioloop = tornado.ioloop.IOLoop.instance()
+        self.processes = processes
+        self.sockets = sockets
+        # pid -> the Box cache stats that helper sent with its last batch
+        self.helper_stats = {}
+        self.executor = self._new_executor() if processes else None
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(self.processes,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_worker, initargs=(self.core, self.sockets))
+
+    def _replace_broken(self, executor):
+        """A helper died (OOM killer, kill -9), which breaks the whole
+           pool for good; swap in a new one. Its helpers are forked on the
+           next submit."""
+        with self.lock:
+            if self.executor is not executor:
+                return
+            self.executor = self._new_executor()
+            self.helper_stats = {}
+        executor.shutdown(wait=False)
+
+    def start(self):
+        """Fork the workers now, while this process has no other threads
+           whose locks they could inherit."""
+        if self.executor:
+            self.executor.submit(_noop).result()
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False)
+
+    def call(self, method, *args):
+        future = Future()
+        trace = tracing.current()
+        if trace is not None:
+            start = time.time()
+            future.add_done_callback(
+                lambda f: trace.add("crypto", time.time() - start))
+        if not self.executor:
+            try:
+                future.set_result(getattr(self.core, method)(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        with self.lock:
+            self.queue.append((future, method, args))
+            queued = len(self.queue)
+        if queued >= BATCH_LIMIT:
+            self.flush()
+        elif queued == 1:
+            self.ioloop.add_callback(self.flush)
+        return future
+
+    def flush(self):
+        with self.lock:
+            batch, self.queue = self.queue, []
+        if not batch:
+            return
+        executor = self.executor
+        try:
+            job = executor.submit(_run_batch, [(method, args)
+                                               for _, method, args in batch])
+        except BrokenProcessPool as e:
+            self._replace_broken(executor)
+            for future, _, _ in batch:
+                future.set_exception(e)
+            return
+        job.add_done_callback(lambda job: self._resolve(batch, job, executor))
+
+    def _resolve(self, batch, job, executor):
+        error = job.exception()
+        if error is not None:
+            if isinstance(error, BrokenProcessPool):
+                self._replace_broken(executor)
+            for future, _, _ in batch:
+                future.set_exception(error)
+            return
+        results, (pid, stats) = job.result()
+        with self.lock:
+            if self.executor is executor:
+                self.helper_stats[pid] = stats
+        for (future, _, _), (ok, result) in zip(batch, results):
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+    def box_stats(self):
+        """CryptoCore.box_stats(), summed over the helpers when the Boxes
+           are built (and cached) there. A helper's numbers are as of the
+           last batch it ran."""
+        if not self.executor:
+            return self.core.box_stats()
+        with self.lock:
+            helpers = list(self.helper_stats.values())
+        stats = {key: sum(helper[key] for helper in helpers)
+                 for key in ("size", "weight", "capacity", "hits", "misses",
+                             "evictions")}
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = float(stats["hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def sign_record(self, name, public_key, pin, checksum):
+        return self.call("sign_fields", name, public_key, pin, checksum)
+
+    def sign_raw(self, data):
+        return self.call("sign_raw", data)
+
+    def open_box(self, client, nonce, ciphertext):
+        return self.call("open_box", client, nonce, ciphertext)
+
+    def hash_password(self, password):
+        return self.call("hash_password", password)
+
+    def check_password(self, stored, password):
+        return self.call("check_password", stored, password)
@@ -6,13 +6,28 @@
 """
 import sqlalchemy
 import sqlalchemy.exc
+import sqlalchemy.event
+import sqlalchemy.pool
+import sqlalchemy.orm.attributes
 from sqlalchemy import Integer, DateTime, Unicode, Column, String, Binary
 from sqlalchemy.ext.declarative import declarative_base
 from string import printable
 import re
+import time
 import threading
+import itertools
 import math
 import hashlib
+import datetime
+import os
+import binascii
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import cache
+import migrations
+import search_index
+import tracing
 
 """
 Module summary: manages the database of users.
@@ -22,6 +37,27 @@ NON_SPECIAL = set(printable) - {":", ";", "(", ")"}
 BASE = declarative_base()
 DJB_SPECIAL = re.compile(r"([;=:])")
 PRESENCE_CACHE_CEILING = 1000
+NEGATIVE_CACHE_CEILING = 1000
+NEGATIVE_CACHE_TTL = 60
+# Events are polled every second or so; keep them well past that.
+EVENT_RETENTION = datetime.timedelta(hours=1)
+# Ids may commit out of order on Postgres, so re-read this many back.
+EVENT_LOOKBACK = 64
+PAGE_BOUNDS_CEILING = 1024
+# A remembered page boundary is reused until records adding up to this
+# fraction of a page have been written since it was found, as each can
+# move the pages after it by a row.
+PAGE_BOUNDS_DRIFT = 0.1
+# WAL lets readers carry on while a write commits; with it, NORMAL only
+# risks the last commits on power loss, never corruption.
+SQLITE_PRAGMAS = {"journal_mode": "wal", "synchronous": "normal"}
+VALID_PRAGMA = re.compile(r"^[A-Za-z_]+$")
+VALID_PRAGMA_VALUE = re.compile(r"^-?\w+$")
+POOL_OPTIONS = {"pool_size", "max_overflow", "pool_recycle", "pool_timeout"}
+# seconds a replica may be behind the primary; records written more
+# recently than this are read from the primary
+REPLICA_LAG = 10
+EPOCH = datetime.datetime(1970, 1, 1)
 OCT_ENCODE = lambda c: "\\" + "{0:o}".format(ord(c.group(0))).zfill(3)
 
 class User(BASE):
@@ -70,13 +106,45 @@ class User(BASE):
                              if not suffix.endswith(".") else suffix))
 
     def is_password_matching(self, checkpass):
-        salt, correct_digest = self.password[:16], self.password[16:]
-        hash_ = hashlib.sha512(salt)
-        hash_.update(checkpass.encode("utf8"))
-        if hash_.digest() == correct_digest:
-            return 1
-        else:
-            return 0
+        return check_password(self.password, checkpass)
+
+def hash_password(password):
+    """The stored form of password: a random salt and its SHA-512."""
+    salt = os.urandom(16)
+    return salt + hashlib.sha512(salt + password.encode("utf8")).digest()
+
+def check_password(stored, checkpass):
+    salt, correct_digest = stored[:16], stored[16:]
+    hash_ = hashlib.sha512(salt)
+    hash_.update(checkpass.encode("utf8"))
+    if hash_.digest() == correct_digest:
+        return 1
+    else:
+        return 0
+
+def encode_cursor(user):
+    """Keyset cursor for the /friends listing, positioned after user."""
+    delta = user.timestamp - EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return "{0}_{1}".format(micros, user.user_id)
+
+def decode_cursor(text):
+    """Inverse of encode_cursor. Returns None for malformed input."""
+    try:
+        micros, user_id = (int(part) for part in text.split("_"))
+        return EPOCH + datetime.timedelta(microseconds=micros), user_id
+    except (ValueError, OverflowError):
+        return None
+
+class RecordEvent(BASE):
+    """One committed change to records, so other processes sharing the
+       database know exactly which cache entries to drop."""
+    __tablename__ = "record_events"
+    event_id = Column(Integer, primary_key=True)
+    origin = Column(String)
+    name = Column(Unicode)
+    public_key = Column(String)
+    timestamp = Column(DateTime)
 
 class StaleUser(object):
     def __init__(self, u):
@@ -90,6 +158,9 @@ class StaleUser(object):
         self.sig = u.sig
         self.pin = u.pin
         self.password = u.password
+        # things derived from this version of the record, such as encoded
+        # responses; a write replaces the cached StaleUser, and this with it
+        self.memo = {}
 
     def is_searchable(self):
         return User.is_searchable(self)
@@ -107,81 +178,350 @@ class StaleUser(object):
         return User.is_password_matching(self, checkpass)
 
 class Database(object):
-    def __init__(self, backing="sqlite:///:memory:", should_echo=1):
-        self.presence_cache = {}
+    """pool holds create_engine's pool_size, max_overflow, pool_recycle
+       and pool_timeout; pragmas are set on every SQLite connection, over
+       SQLITE_PRAGMAS. Lookups by name or key, the listing and search go
+       to the replicas, if any, in turn (see read_session); writes and
+       everything else go to backing. should_echo logs every statement,
+       the once-a-second poll_events included, so it is off by default."""
+    def __init__(self, backing="sqlite:///:memory:", should_echo=0,
+                 pool=None, pragmas=None, replicas=(),
+                 replica_lag=REPLICA_LAG):
+        self.presence_cache = cache.SegmentedCache(
+            PRESENCE_CACHE_CEILING, negative_capacity=NEGATIVE_CACHE_CEILING,
+            negative_ttl=NEGATIVE_CACHE_TTL)
+        # public_key -> name, resolved through presence_cache
+        self.key_cache = cache.SegmentedCache(
+            PRESENCE_CACHE_CEILING, negative_capacity=NEGATIVE_CACHE_CEILING,
+            negative_ttl=NEGATIVE_CACHE_TTL)
         self.backing = backing
         self.should_echo = should_echo
+        self.pool = dict(pool or {})
+        if not POOL_OPTIONS.issuperset(self.pool):
+            raise ValueError("unknown pool options: {0}".format(
+                ", ".join(sorted(set(self.pool) - POOL_OPTIONS))))
+        self.pragmas = dict(SQLITE_PRAGMAS, **(pragmas or {}))
+        for name, value in self.pragmas.items():
+            if (not VALID_PRAGMA.match(name) or
+                    not VALID_PRAGMA_VALUE.match(str(value))):
+                raise ValueError("bad pragma {0} = {1}".format(name, value))
+        self.replica_urls = list(replicas)
+        self.replica_lag = replica_lag
+        self.replicas = []
+        # when each record was last written, oldest first, and when
+        # anything was; only the last replica_lag seconds are kept
+        self.recently_written = OrderedDict()
+        self.last_written = 0
         self.lock = threading.RLock()
+        self.cache_lock = threading.RLock()
         self.cached_first_page = None
-        self.cached_page_count = None
-        self.cached_user_count = None
+        # kept current by every write and reconciled with COUNT(*) from
+        # time to time; None until the first reconcile_counts
+        self.user_count = None
+        self.searchable_count = None
+        # (length, page number) -> (cursor that page starts after,
+        # rows_changed when it was found)
+        self.page_bounds = {}
+        # records written so far, here or (via poll_events) elsewhere
+        self.rows_changed = 0
+        # bumped after every committed write; readers running on other
+        # threads only cache what they read if it hasn't moved meanwhile
+        self.generation = 0
+        # identifies our own events in record_events
+        self.origin = binascii.hexlify(os.urandom(8)).decode("ascii")
+        self.last_event = 0
+        self.seen_events = set()
+        self.search_index = search_index.TrigramIndex()
+        # called as hook(names) after every committed write, with
+        # cache_lock held, so caches built on top of ours can follow
+        self.write_hooks = []
+
+    def _create_engine(self, url=None):
+        url = url or self.backing
+        if url in ("sqlite://", "sqlite:///:memory:"):
+            # one shared connection, or each pool thread gets its own
+            # empty in-memory database
+            engine = sqlalchemy.create_engine(url,
+                echo=self.should_echo, poolclass=sqlalchemy.pool.StaticPool,
+                connect_args={"check_same_thread": False})
+        elif url.startswith("sqlite"):
+            # the default for SQLite files opens a connection per session,
+            # and with it a cold page cache; a pool hands each connection
+            # to one thread at a time
+            engine = sqlalchemy.create_engine(url,
+                echo=self.should_echo, poolclass=sqlalchemy.pool.QueuePool,
+                connect_args={"check_same_thread": False}, **self.pool)
+        else:
+            engine = sqlalchemy.create_engine(url, echo=self.should_echo,
+                                              **self.pool)
+        if engine.dialect.name == "sqlite":
+            pragmas = ["PRAGMA {0} = {1}".format(name, value)
+                       for name, value in self.pragmas.items()]
+            @sqlalchemy.event.listens_for(engine, "connect")
+            def connect(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                for pragma in pragmas:
+                    cursor.execute(pragma)
+                cursor.close()
+        return engine
+
+    def engines(self):
+        return [self.dbc] + [engine for engine, _ in self.replicas]
+
+    def create_schema(self, log=None):
+        """Create missing tables and apply pending migrations without
+           setting up the rest of the Database, so one process can do it
+           before others start."""
+        engine = self._create_engine()
+        BASE.metadata.create_all(engine)
+        migrations.upgrade(engine, log)
+        engine.dispose()
 
     def late_init(self):
         self.requests_serviced = 0
-        self.dbc = sqlalchemy.create_engine(self.backing, echo=self.should_echo)
+        self.dbc = self._create_engine()
         BASE.metadata.create_all(self.dbc)
         self.gs = sqlalchemy.orm.sessionmaker(bind=self.dbc)
+        for url in self.replica_urls:
+            engine = self._create_engine(url)
+            self.replicas.append((engine,
+                                  sqlalchemy.orm.sessionmaker(bind=engine)))
+        self.next_replica = itertools.cycle([rs for _, rs in self.replicas])
+        sess = self.gs()
+        self.last_event = sess.query(
+            sqlalchemy.func.max(RecordEvent.event_id)).scalar() or 0
+        # already in the counts reconcile_counts is about to take, so the
+        # first poll mustn't count them again
+        self.seen_events = {event_id for (event_id,)
+                            in sess.query(RecordEvent.event_id).filter(
+                                RecordEvent.event_id >
+                                self.last_event - EVENT_LOOKBACK)}
+        sess.close()
+        self.rebuild_search_index()
+        self.reconcile_counts()
+
+    def rebuild_search_index(self):
+        sess = self.gs()
+        self.search_index.clear()
+        for (name,) in sess.query(User.name).filter(User.privacy > 0):
+            self.search_index.add(name)
+        sess.close()
+
+    def _index_entity(self, user):
+        if user.is_searchable():
+            self.search_index.add(user.name)
+        else:
+            self.search_index.discard(user.name)
 
     def _cache_entity_ins(self, name, prefetch):
-        if len(self.presence_cache) > PRESENCE_CACHE_CEILING:
-            self.presence_cache.popitem()
         u = StaleUser(prefetch)
-        self.presence_cache[name] = u
+        with self.cache_lock:
+            old = self.presence_cache.peek(name, None)
+            if old and old.public_key != u.public_key:
+                self.key_cache.discard(old.public_key)
+            self.presence_cache.put(name, u)
+            self.key_cache.put(u.public_key, name)
         return u
 
+    def read_session(self, name=None):
+        """A session for a read that may go to a replica: name's record,
+           or with no name, anything, must not have been written in the
+           last replica_lag seconds, or the replica may not have it yet."""
+        if not self.replicas:
+            return self.gs()
+        horizon = time.time() - self.replica_lag
+        written = (self.last_written if name is None
+                   else self.recently_written.get(name, 0))
+        return self.gs() if written > horizon else next(self.next_replica)()
+
     def _cache_entity_sel(self, name):
-        sess = self.gs()
+        generation = self.generation
+        sess = self.read_session(name)
         ex = sess.query(User).filter_by(name=name).first()
-        if len(self.presence_cache) > PRESENCE_CACHE_CEILING:
-            self.presence_cache.popitem()
-        u = StaleUser(ex) if ex else None
-        self.presence_cache[name] = u
+        with self.cache_lock:
+            if generation != self.generation:
+                u = StaleUser(ex) if ex else None
+            elif ex:
+                u = self._cache_entity_ins(name, ex)
+            else:
+                u = None
+                self.presence_cache.put_negative(name)
         sess.close()
         return u
 
-    def _cache_entity_rem(self, name, prefetch):
-        self.presence_cache[name] = -1
-        return prefetch
-
-    def get(self, name):
+    def _written(self, names):
+        """Call with cache_lock held, right after a commit that changed
+           the records called names."""
+        self.generation += 1
+        self.rows_changed += len(names)
+        self.cached_first_page = None
+        if self.replicas:
+            now = self.last_written = time.time()
+            for name in names:
+                self.recently_written.pop(name, None)
+                self.recently_written[name] = now
+            horizon = now - self.replica_lag
+            while (self.recently_written and
+                   next(iter(self.recently_written.values())) < horizon):
+                self.recently_written.popitem(last=False)
+        for hook in self.write_hooks:
+            hook(names)
+
+    def _cache_entity_rem(self, name):
+        with self.cache_lock:
+            old = self.presence_cache.peek(name, None)
+            if old:
+                self.key_cache.discard(old.public_key)
+            self.presence_cache.discard(name)
+
+    def get_cached(self, name):
+        """The cached record for name, None if it is known not to exist,
+           or cache.MISS if only the database can tell."""
         self.requests_serviced += 1
-        e = self.presence_cache.get(name, -1)
-        return e if e != -1 else self._cache_entity_sel(name)
+        return self.presence_cache.get(name)
 
-    def get_page(self, num, length):
-        if num != 0 or self.cached_first_page is None:
-            sess, records = self.get_page_ig(num, length)
+    def get(self, name):
+        e = self.get_cached(name)
+        return e if e is not cache.MISS else self._cache_entity_sel(name)
+
+    def get_many_cached(self, names):
+        """Split names into a dict of what the cache knows (records or
+           None) and a list of names only the database can answer."""
+        found, missing = {}, []
+        for name in names:
+            e = self.get_cached(name)
+            if e is cache.MISS:
+                missing.append(name)
+            else:
+                found[name] = e
+        return found, missing
+
+    def get_many_by_id_cached(self, ids):
+        """Like get_many_cached, keyed by the 64-char public key."""
+        found, missing = {}, []
+        for id in ids:
+            pkey = id.upper()[0:64]
+            e = self.get_by_id_cached(pkey)
+            if e is cache.MISS:
+                missing.append(pkey)
+            else:
+                found[pkey] = e
+        return found, missing
+
+    def _select_many(self, column, keys):
+        """One IN query for keys, caching what comes back. Returns a dict
+           of key -> StaleUser or None."""
+        generation = self.generation
+        sess = self.read_session()
+        rows = sess.query(User).filter(column.in_(keys)).all()
+        sess.close()
+        by_key = {getattr(row, column.key): row for row in rows}
+        results = {}
+        with self.cache_lock:
+            fresh = generation == self.generation
+            for key in keys:
+                row = by_key.get(key)
+                if not fresh:
+                    results[key] = StaleUser(row) if row else None
+                elif row:
+                    results[key] = self._cache_entity_ins(row.name, row)
+                else:
+                    results[key] = None
+                    if column is User.name:
+                        self.presence_cache.put_negative(key)
+                    else:
+                        self.key_cache.put_negative(key)
+        return results
+
+    def get_many(self, names):
+        found, missing = self.get_many_cached(names)
+        if missing:
+            found.update(self._select_many(User.name, missing))
+        return found
+
+    def get_many_by_id(self, ids):
+        found, missing = self.get_many_by_id_cached(ids)
+        if missing:
+            found.update(self._select_many(User.public_key, missing))
+        return found
+
+    def cache_stats(self):
+        return {"name": self.presence_cache.stats(),
+                "public_key": self.key_cache.stats()}
+
+    def get_page(self, num, length, after=None):
+        if num != 0 or after or self.cached_first_page is None:
+            sess, records = self.get_page_ig(num, length, after=after)
             sess.close()
             return records
         else:
             return self.cached_first_page
 
     def count_users(self):
-        return (self.cached_user_count if self.cached_user_count is not None
-                                       else self.count_users_ig())
+        if self.user_count is None:
+            self.reconcile_counts()
+        return self.user_count
 
     def count_pages(self, length):
-        return (self.cached_page_count if self.cached_page_count is not None
-                                       else self.count_pages_ig(length))
+        """Pages in the /friends listing, which only shows searchable
+           users."""
+        if self.searchable_count is None:
+            self.reconcile_counts()
+        return int(math.ceil(float(self.searchable_count) / length))
+
+    def _counted(self, users, searchable):
+        """Call with cache_lock held: apply a committed write's change to
+           the counters."""
+        if self.user_count is not None:
+            self.user_count += users
+            self.searchable_count += searchable
+
+    def reconcile_counts(self):
+        """Recount from the database, correcting any drift (writes from
+           other processes aren't counted as they happen). Returns
+           (users, searchable)."""
+        generation = self.generation
+        users = self.count_users_ig()
+        searchable = self.count_searchable_ig()
+        with self.cache_lock:
+            # a write that committed meanwhile may or may not be in the
+            # counts above; the incremental values are right either way
+            if generation == self.generation or self.user_count is None:
+                self.user_count = users
+                self.searchable_count = searchable
+        return users, searchable
 
     def contains(self, name):
-        e = self.presence_cache.get(name, -1)
-        return 1 if e != -1 else bool(self._cache_entity_sel(name))
+        return bool(self.get(name))
+
+    def _event(self, name, public_key):
+        return RecordEvent(origin=self.origin, name=name,
+                           public_key=public_key,
+                           timestamp=datetime.datetime.now())
 
     def update_atomic(self, object_, s=None):
         s = s or self.gs()
+        inserted = object_.user_id is None
+        privacy = sqlalchemy.orm.attributes.get_history(object_, "privacy")
+        was_searchable = not inserted and (privacy.deleted[0]
+            if privacy.deleted else object_.privacy) > 0
         s.add(object_)
+        s.add(self._event(object_.name, object_.public_key))
         try:
             s.commit()
-            self._cache_entity_ins(object_.name, object_)
+            # refreshes the expired instance, so do it outside the lock
+            fresh = StaleUser(object_)
+            with self.cache_lock:
+                self._written([fresh.name])
+                self._counted(int(inserted),
+                              int(fresh.is_searchable()) - int(was_searchable))
+                self._cache_entity_ins(fresh.name, fresh)
+            self._index_entity(fresh)
         except sqlalchemy.exc.IntegrityError as e:
             print(e)
             return 0
         finally:
             s.close()
-        self.cached_first_page = None
-        self.cached_page_count = None
-        self.cached_user_count = None
         return 1
 
     def get_ig(self, name, sess=None):
@@ -194,39 +534,134 @@ class Database(object):
         ex = sess.query(User).filter_by(public_key=id).first()
         return sess, ex
 
+    def get_by_id_cached(self, id):
+        """Like get_cached, for a public key."""
+        pkey = id.upper()[0:64]
+        name = self.key_cache.get(pkey)
+        if name is None:
+            return None
+        if name is not cache.MISS:
+            e = self.presence_cache.get(name)
+            if e and e.public_key == pkey:
+                return e
+        return cache.MISS
+
     def get_by_id(self, id, sess=None):
-        sess = sess or self.gs()
-        id = id.upper()
-        pkey = id[0:64]
+        e = self.get_by_id_cached(id)
+        return e if e is not cache.MISS else self._cache_entity_sel_id(id, sess)
 
+    def _cache_entity_sel_id(self, id, sess=None):
+        generation = self.generation
+        pkey = id.upper()[0:64]
+        sess = sess or self.read_session()
         ex = sess.query(User).filter_by(public_key=pkey).first()
-        u = StaleUser(ex) if ex else None
+        with self.cache_lock:
+            if generation != self.generation:
+                u = StaleUser(ex) if ex else None
+            elif ex:
+                u = self._cache_entity_ins(ex.name, ex)
+            else:
+                u = None
+                self.key_cache.put_negative(pkey)
         sess.close()
-        print (u.privacy)
         return u
 
-    def get_page_ig(self, num, length, sess=None):
-        sess = sess or self.gs()
-        ex = (sess.query(User).filter(User.privacy > 0).order_by(User.timestamp.desc())
-                              .limit(length).offset(num * length))
-        make_stale = lambda n: (self.presence_cache.get(n.name, 0)
-                                or self._cache_entity_ins(n.name, n))
+    def _page_query(self, sess, after, *columns):
+        """Searchable users newest first, starting after the keyset
+           cursor after (a (timestamp, user_id) pair, or None)."""
+        q = sess.query(*columns) if columns else sess.query(User)
+        q = q.filter(User.privacy > 0)
+        if after:
+            timestamp, user_id = after
+            q = q.filter(sqlalchemy.or_(
+                User.timestamp < timestamp,
+                sqlalchemy.and_(User.timestamp == timestamp,
+                                User.user_id < user_id)))
+        return q.order_by(User.timestamp.desc(), User.user_id.desc())
+
+    def page_cursor(self, num, length, sess):
+        """The cursor page num starts after, or cache.MISS if there is no
+           such page. Boundaries are remembered, so reaching page n walks
+           only the keys between it and the nearest page already seen.
+           A boundary is trusted until PAGE_BOUNDS_DRIFT of a page's worth
+           of records have been written, and only while its own row stays
+           where it was."""
         if num == 0:
-            self.cached_first_page = [make_stale(x) for x in ex]
-            return sess, self.cached_first_page
-        else:
-            return sess, [make_stale(x) for x in ex]
+            return None
+        changed = self.rows_changed
+        bounds = self.page_bounds
+        oldest = changed - int(length * PAGE_BOUNDS_DRIFT)
+        known = sorted(((n, cursor, found) for (l, n), (cursor, found)
+                        in list(bounds.items())
+                        if l == length and n <= num and found >= oldest),
+                       reverse=True)
+        start, after = 0, None
+        for n, cursor, found in known:
+            if found == changed or self._is_in_place(sess, cursor):
+                start, after = n, cursor
+                break
+            with self.cache_lock:
+                bounds.pop((length, n), None)
+        if start == num:
+            return after
+
+        keys = (self._page_query(sess, after, User.timestamp, User.user_id)
+                .limit((num - start) * length).all())
+        if len(keys) < (num - start) * length:
+            return cache.MISS
+        # stamped with the count the walk began at, so a write that raced
+        # it only makes the boundaries age sooner
+        with self.cache_lock:
+            if len(bounds) > PAGE_BOUNDS_CEILING:
+                bounds.clear()
+            for step in range(1, num - start + 1):
+                bounds[(length, start + step)] = (
+                    tuple(keys[step * length - 1]), changed)
+        return tuple(keys[-1])
+
+    def _is_in_place(self, sess, cursor):
+        """Whether the row cursor was taken from is still listed there."""
+        timestamp, user_id = cursor
+        return sess.query(User.user_id).filter(
+            User.user_id == user_id, User.timestamp == timestamp,
+            User.privacy > 0).first() is not None
+
+    def get_page_ig(self, num, length, sess=None, after=None):
+        """Page num of the /friends listing. A cursor from encode_cursor
+           may be given as after, in which case num is not consulted."""
+        generation = self.generation
+        sess = sess or self.read_session()
+        if not after:
+            after = self.page_cursor(num, length, sess)
+            if after is cache.MISS:
+                return sess, []
+        ex = self._page_query(sess, after).limit(length).all()
+        # peek, not get: a crawler walking pages must not promote every
+        # row it sees into the protected segment
+        with self.cache_lock:
+            if generation != self.generation:
+                return sess, [StaleUser(x) for x in ex]
+            page = [self.presence_cache.peek(x.name, None)
+                    or self._cache_entity_ins(x.name, x) for x in ex]
+            if num == 0 and not after:
+                self.cached_first_page = page
+        return sess, page
 
     def count_pages_ig(self, length):
-        sess = self.gs()
-        count = sess.query(User).count()
-        self.cached_page_count = math.ceil(float(count) / length)
-        return self.cached_page_count
+        return int(math.ceil(float(self.count_searchable_ig()) / length))
 
     def count_users_ig(self):
         sess = self.gs()
-        self.cached_user_count = sess.query(User).count()
-        return self.cached_user_count
+        count = sess.query(sqlalchemy.func.count(User.user_id)).scalar()
+        sess.close()
+        return count
+
+    def count_searchable_ig(self):
+        sess = self.gs()
+        count = (sess.query(sqlalchemy.func.count(User.user_id))
+                 .filter(User.privacy > 0).scalar())
+        sess.close()
+        return count
 
     def iterate_all_users(self, mutates=0):
         sess = self.gs()
@@ -238,21 +673,186 @@ class Database(object):
         sess.close()
 
     def search_users(self, name, length, num):
-        sess = self.gs()
+        names = self.search_index.search(name, length * num, length)
+        if not names:
+            return []
+        sess = self.read_session()
         results = (sess.query(User)
-                   .filter(User.privacy > 0)
+                   .filter(User.name.in_(names), User.privacy > 0)
                    .order_by(User.name))
+        users = [StaleUser(user) for user in results]
         sess.close()
-        result_len = results.count()
-        start = length * num if length * num < result_len else results_len
-        end = start + length if start + length < result_len else results_len
-        return list(user for user in results if name in user.name)[start:end]
+        return users
 
     def delete_pk(self, pk):
         sess = self.gs()
+        rows = (sess.query(User.name, User.privacy)
+                .filter_by(public_key=pk).all())
+        names = [name for (name, _) in rows]
+        searchable = sum(1 for (_, privacy) in rows if privacy > 0)
         sess.query(User).filter_by(public_key=pk).delete()
+        for name in names:
+            sess.add(self._event(name, pk))
         sess.commit()
         sess.close()
-        self.cached_first_page = None
-        self.cached_page_count = None
-        self.cached_user_count = None
+        with self.cache_lock:
+            self._written(names)
+            self._counted(-len(names), -searchable)
+            for name in names:
+                self._cache_entity_rem(name)
+            self.key_cache.discard(pk)
+        for name in names:
+            self.search_index.discard(name)
+
+    def poll_events(self):
+        """Drop the cache entries that other processes have changed since
+           the last poll, and count their records in. Returns how many
+           events were applied."""
+        sess = self.gs()
+        since = self.last_event - EVENT_LOOKBACK
+        events = (sess.query(RecordEvent)
+                  .filter(RecordEvent.event_id > since)
+                  .order_by(RecordEvent.event_id).all())
+        changed = {}
+        for event in events:
+            if event.event_id in self.seen_events:
+                continue
+            self.seen_events.add(event.event_id)
+            self.last_event = max(self.last_event, event.event_id)
+            if event.origin != self.origin:
+                changed[event.name] = event.public_key
+        self.seen_events = {e for e in self.seen_events
+                            if e > self.last_event - EVENT_LOOKBACK}
+        if not changed:
+            sess.close()
+            return 0
+
+        present = dict(sess.query(User.name, User.privacy)
+                       .filter(User.name.in_(list(changed))))
+        searchable = {name for name, privacy in present.items()
+                      if privacy > 0}
+        sess.close()
+        with self.cache_lock:
+            # what each record was before comes from the search index and
+            # the cache; one neither knows about is most likely new, and
+            # reconcile_counts puts it right if not
+            users = listed = 0
+            for name in changed:
+                was_listed = name in self.search_index
+                listed += int(name in searchable) - int(was_listed)
+                existed = was_listed or self.presence_cache.peek(name, None)
+                users += int(name in present) - int(bool(existed))
+            self._counted(users, listed)
+            self._written(list(changed))
+            for name, public_key in changed.items():
+                self._cache_entity_rem(name)
+                self.key_cache.discard(public_key)
+        for name in changed:
+            if name in searchable:
+                self.search_index.add(name)
+            else:
+                self.search_index.discard(name)
+        return len(changed)
+
+    def prune_events(self):
+        sess = self.gs()
+        cutoff = datetime.datetime.now() - EVENT_RETENTION
+        sess.query(RecordEvent).filter(RecordEvent.timestamp < cutoff).delete()
+        sess.commit()
+        sess.close()
+
+class AsyncDatabase(object):
+    """Runs Database queries on a bounded thread pool so a slow query
+       never stalls the IOLoop. Every method returns a Future; answers
+       that are already in memory come back as completed Futures without
+       touching the pool."""
+    def __init__(self, db, max_workers=4):
+        self.db = db
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    @staticmethod
+    def _done(value):
+        future = Future()
+        future.set_result(value)
+        return future
+
+    def run(self, fn, *args):
+        return self.executor.submit(tracing.bind(fn, "db"), *args)
+
+    @property
+    def requests_serviced(self):
+        return self.db.requests_serviced
+
+    def get(self, name):
+        e = self.db.get_cached(name)
+        if e is not cache.MISS:
+            return self._done(e)
+        return self.run(self.db._cache_entity_sel, name)
+
+    def contains(self, name):
+        future = Future()
+
+        def done(f):
+            if f.exception() is not None:
+                future.set_exception(f.exception())
+            else:
+                future.set_result(bool(f.result()))
+        self.get(name).add_done_callback(done)
+        return future
+
+    def get_by_id(self, id):
+        e = self.db.get_by_id_cached(id)
+        if e is not cache.MISS:
+            return self._done(e)
+        return self.run(self.db._cache_entity_sel_id, id)
+
+    def _many(self, found, missing, select):
+        if not missing:
+            return self._done(found)
+        def fill():
+            found.update(select(missing))
+            return found
+        return self.run(fill)
+
+    def get_many(self, names):
+        found, missing = self.db.get_many_cached(names)
+        return self._many(found, missing,
+                          lambda keys: self.db._select_many(User.name, keys))
+
+    def get_many_by_id(self, ids):
+        found, missing = self.db.get_many_by_id_cached(ids)
+        return self._many(found, missing,
+            lambda keys: self.db._select_many(User.public_key, keys))
+
+    def get_page(self, num, length, after=None):
+        if num == 0 and not after and self.db.cached_first_page is not None:
+            return self._done(self.db.cached_first_page)
+        return self.run(self.db.get_page, num, length, after)
+
+    def count_users(self):
+        if self.db.user_count is not None:
+            return self._done(self.db.user_count)
+        return self.run(self.db.count_users)
+
+    def count_pages(self, length):
+        if self.db.searchable_count is not None:
+            return self._done(self.db.count_pages(length))
+        return self.run(self.db.count_pages, length)
+
+    def reconcile_counts(self):
+        return self.run(self.db.reconcile_counts)
+
+    def search_users(self, name, length, num):
+        return self.run(self.db.search_users, name, length, num)
+
+    def update_atomic(self, object_, s=None):
+        return self.run(self.db.update_atomic, object_, s)
+
+    def delete_pk(self, pk):
+        return self.run(self.db.delete_pk, pk)
+
+    def poll_events(self):
+        return self.run(self.db.poll_events)
+
+    def prune_events(self):
+        return self.run(self.db.prune_events)
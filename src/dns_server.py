@@ -0,0 +1,315 @@
+"""
+* dns_server.py
+* Further licensing information: see LICENSE.
+"""
+import socket
+import struct
+import asyncio
+import threading
+
+import cache
+
+"""
+Module summary: an authoritative DNS server for _tox.<domain>, answering
+TXT queries for name._tox.<domain> with the record User.record() builds,
+over UDP and TCP.
+
+It runs an asyncio loop on its own thread beside the Tornado IOLoop and
+reads through the same Database: cached records are answered on the spot,
+others are fetched on the database threads. The encoded answer is kept in
+the cached record's memo, so it is dropped with the record when a publish
+or delete (here or, via record_events, in another worker) replaces it.
+
+Delegate _tox.<domain> to the host(s) running this, e.g.
+
+    _tox.example.com.     NS  ns.example.com.
+"""
+
+TYPE_NS = 2
+TYPE_SOA = 6
+TYPE_TXT = 16
+TYPE_OPT = 41
+TYPE_ANY = 255
+CLASS_IN = 1
+CLASS_ANY = 255
+
+NOERROR = 0
+FORMERR = 1
+SERVFAIL = 2
+NXDOMAIN = 3
+NOTIMP = 4
+REFUSED = 5
+
+FLAG_QR = 0x8000
+FLAG_AA = 0x0400
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+
+HEADER = struct.Struct("!HHHHHH")
+RR_FIXED = struct.Struct("!HHIH")
+UDP_LIMIT = 512
+# the largest reply we send over UDP to EDNS clients, whatever they offer
+EDNS_LIMIT = 1232
+TCP_LIMIT = 65535
+TCP_IDLE = 10
+# also how long resolvers may remember that a name doesn't exist
+TTL = 60
+SOA_TIMERS = (3600, 600, 86400)  # refresh, retry, expire
+
+class Malformed(ValueError):
+    pass
+
+class Query(object):
+    __slots__ = ("id", "flags", "opcode", "question", "labels", "qtype",
+                 "qclass", "edns", "limit", "name")
+
+def encode_name(name):
+    return b"".join(bytes((len(label),)) + label
+                    for label in name.rstrip(".").encode("idna").split(b".")
+                    if label) + b"\x00"
+
+def txt_rdata(text):
+    data = text.encode("utf8")
+    return b"".join(bytes((len(data[i:i + 255]),)) + data[i:i + 255]
+                    for i in range(0, len(data), 255)) or b"\x00"
+
+def parse(packet, limit):
+    """A Query for packet. Raises Malformed, whose args are the id and the
+       reply rcode, or (None,) when there isn't even a header."""
+    if len(packet) < HEADER.size:
+        raise Malformed(None)
+    id_, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(
+        packet)
+    if flags & FLAG_QR:
+        raise Malformed(None)
+    query = Query()
+    query.id, query.flags = id_, flags
+    query.opcode = (flags >> 11) & 0xF
+    query.edns = None
+    query.limit = limit
+    query.name = None
+    if query.opcode != 0:
+        raise Malformed(id_, NOTIMP)
+    if qdcount != 1:
+        raise Malformed(id_, FORMERR)
+
+    labels, offset, total = [], HEADER.size, 0
+    while 1:
+        if offset >= len(packet):
+            raise Malformed(id_, FORMERR)
+        length = packet[offset]
+        offset += 1
+        if not length:
+            break
+        # compression has no business in a lone question
+        if length & 0xC0:
+            raise Malformed(id_, FORMERR)
+        total += length + 1
+        if total > 254 or offset + length > len(packet):
+            raise Malformed(id_, FORMERR)
+        labels.append(packet[offset:offset + length])
+        offset += length
+    if offset + 4 > len(packet):
+        raise Malformed(id_, FORMERR)
+    query.qtype, query.qclass = struct.unpack_from("!HH", packet, offset)
+    offset += 4
+    query.labels = labels
+    query.question = packet[HEADER.size:offset]
+
+    # an OPT record, if any, is usually the only additional one
+    if arcount and packet[offset:offset + 3] == b"\x00\x00\x29":
+        size, = struct.unpack_from("!H", packet, offset + 3)
+        query.edns = packet[offset + 6] if offset + 7 <= len(packet) else 0
+        if limit != TCP_LIMIT:
+            query.limit = min(max(size, UDP_LIMIT), EDNS_LIMIT)
+    return query
+
+class Responder(object):
+    """Builds replies for the zone _tox.<domain>. Shared by the UDP and TCP
+       servers; only ever used from the DNS thread."""
+    def __init__(self, db, async_store, domain, ttl, nameserver=None,
+                 metrics=None):
+        self.db = db
+        self.async_store = async_store
+        self.ttl = ttl
+        self.metrics = metrics
+        zone = "_tox." + domain.rstrip(".")
+        nameserver = nameserver or "ns." + domain.rstrip(".")
+        self.apex = encode_name(zone)
+        self.apex_labels = [label.lower() for label in
+                            zone.encode("idna").split(b".")]
+
+        soa = b"".join((encode_name(nameserver),
+                        encode_name("hostmaster." + domain),
+                        struct.pack("!IIIII", 1, SOA_TIMERS[0], SOA_TIMERS[1],
+                                    SOA_TIMERS[2], ttl)))
+        self.soa = self._rr(self.apex, TYPE_SOA, soa)
+        self.ns = self._rr(self.apex, TYPE_NS, encode_name(nameserver))
+
+    def _rr(self, owner, type_, rdata):
+        return b"".join((owner, RR_FIXED.pack(type_, CLASS_IN, self.ttl,
+                                              len(rdata)), rdata))
+
+    def _answer_rr(self, rec):
+        """rec's TXT answer, named by a pointer to the question. Built once
+           per version of the record."""
+        rr = rec.memo.get("dns")
+        if rr is None:
+            rdata = txt_rdata(rec.record(0))
+            rr = rec.memo["dns"] = b"".join((
+                b"\xc0\x0c", RR_FIXED.pack(TYPE_TXT, CLASS_IN, self.ttl,
+                                           len(rdata)), rdata))
+        return rr
+
+    def _reply(self, query, rcode, answer=b"", authority=b""):
+        opt = b""
+        if query.edns is not None:
+            # version 0 only; anything else is BADVERS, extended rcode 16
+            extended = 0 if query.edns == 0 else 1
+            opt = b"\x00" + struct.pack("!HHBBHH", TYPE_OPT, EDNS_LIMIT,
+                                        extended, 0, 0, 0)
+            if extended:
+                rcode, answer, authority = 16, b"", b""
+        flags = FLAG_QR | (query.flags & FLAG_RD) | (rcode & 0xF)
+        if rcode != REFUSED:
+            flags |= FLAG_AA
+        size = HEADER.size + len(query.question) + len(answer) + \
+            len(authority) + len(opt)
+        if size > query.limit:
+            flags |= FLAG_TC
+            answer = authority = b""
+        self._count(rcode)
+        return b"".join((
+            HEADER.pack(query.id, flags, 1, 1 if answer else 0,
+                        1 if authority else 0, 1 if opt else 0),
+            query.question, answer, authority, opt))
+
+    def _error(self, id_, rcode):
+        self._count(rcode)
+        return HEADER.pack(id_, FLAG_QR | rcode, 0, 0, 0, 0)
+
+    def _count(self, rcode):
+        if self.metrics:
+            self.metrics.inc("dns_queries_total", rcode=rcode)
+
+    def respond(self, packet, limit):
+        """The reply to packet; None to drop it; or a Query whose record
+           isn't cached, for finish() once it has been fetched."""
+        try:
+            query = parse(packet, limit)
+        except Malformed as e:
+            return None if e.args[0] is None else self._error(*e.args)
+        if query.qclass not in (CLASS_IN, CLASS_ANY):
+            return self._reply(query, REFUSED)
+
+        labels = [label.lower() for label in query.labels]
+        depth = len(self.apex_labels)
+        if labels[-depth:] != self.apex_labels:
+            return self._reply(query, REFUSED)
+        if len(labels) == depth:
+            if query.qtype in (TYPE_SOA, TYPE_ANY):
+                return self._reply(query, NOERROR, answer=self.soa)
+            if query.qtype == TYPE_NS:
+                return self._reply(query, NOERROR, answer=self.ns)
+            return self._reply(query, NOERROR, authority=self.soa)
+
+        try:
+            query.name = b".".join(labels[:-depth]).decode("utf8")
+        except UnicodeDecodeError:
+            return self._reply(query, NXDOMAIN, authority=self.soa)
+        rec = self.db.get_cached(query.name)
+        if rec is cache.MISS:
+            return query
+        return self.finish(query, rec)
+
+    def finish(self, query, rec):
+        if not rec:
+            return self._reply(query, NXDOMAIN, authority=self.soa)
+        if query.qtype in (TYPE_TXT, TYPE_ANY):
+            return self._reply(query, NOERROR, answer=self._answer_rr(rec))
+        return self._reply(query, NOERROR, authority=self.soa)
+
+    async def fetch(self, query):
+        """finish() for a Query respond() returned."""
+        try:
+            rec = await asyncio.wrap_future(self.async_store.get(query.name))
+        except Exception:
+            return self._reply(query, SERVFAIL)
+        return self.finish(query, rec)
+
+    async def resolve(self, packet, limit):
+        """respond(), fetching the record if need be."""
+        reply = self.respond(packet, limit)
+        if isinstance(reply, Query):
+            reply = await self.fetch(reply)
+        return reply
+
+class UDPServer(asyncio.DatagramProtocol):
+    def __init__(self, responder):
+        self.responder = responder
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, packet, addr):
+        reply = self.responder.respond(packet, UDP_LIMIT)
+        if isinstance(reply, Query):
+            asyncio.ensure_future(self._send_later(reply, addr))
+        elif reply is not None:
+            self.transport.sendto(reply, addr)
+
+    async def _send_later(self, query, addr):
+        self.transport.sendto(await self.responder.fetch(query), addr)
+
+def serve_tcp(responder):
+    async def handle(reader, writer):
+        try:
+            while 1:
+                length, = struct.unpack("!H", await asyncio.wait_for(
+                    reader.readexactly(2), TCP_IDLE))
+                packet = await asyncio.wait_for(reader.readexactly(length),
+                                                TCP_IDLE)
+                reply = await responder.resolve(packet, TCP_LIMIT)
+                if reply is None:
+                    break
+                writer.write(struct.pack("!H", len(reply)) + reply)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError,
+                ConnectionError):
+            pass
+        finally:
+            writer.close()
+    return handle
+
+def bind_sockets(port, address):
+    """The UDP and TCP sockets to serve on, bound now (while we may still
+       be root) and shared by every worker."""
+    family = socket.AF_INET6 if ":" in address else socket.AF_INET
+    udp = socket.socket(family, socket.SOCK_DGRAM)
+    udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    udp.bind((address, port))
+    udp.setblocking(False)
+    tcp = socket.socket(family, socket.SOCK_STREAM)
+    tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    tcp.bind((address, port))
+    tcp.listen(128)
+    tcp.setblocking(False)
+    return [udp, tcp]
+
+def start(responder, sockets):
+    """Serve on sockets (from bind_sockets) from a new daemon thread."""
+    udp, tcp = sockets
+    loop = asyncio.new_event_loop()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(loop.create_datagram_endpoint(
+            lambda: UDPServer(responder), sock=udp))
+        loop.run_until_complete(asyncio.start_server(serve_tcp(responder),
+                                                     sock=tcp))
+        loop.run_forever()
+
+    thread = threading.Thread(target=run, name="dns", daemon=True)
+    thread.start()
+    return thread
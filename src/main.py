@@ -8,6 +8,11 @@
 import tornado.ioloop
 import tornado.httpserver
 import tornado.web
+import tornado.gen
+import tornado.escape
+import tornado.websocket
+import tornado.netutil
+import tornado.process
 import tornado.log
 import os
 import json
@@ -18,6 +23,7 @@ import nacl.exceptions
 import database
 import datetime
 import time
+import signal
 import logging
 import re
 import pwd
@@ -25,13 +31,22 @@ import grp
 import sys
 import random
 import hashlib
+import email.utils
 import urllib.parse as parse
-from collections import Counter, defaultdict
+from collections import deque
 import base64
 import binascii
+import hmac
+import functools
 
 import error_codes
 import barcode
+import cache
+import crypto_pool
+import ratelimit
+import metrics
+import tracing
+import dns_server
 
 tornado.log.enable_pretty_logging()
 LOGGER = logging.getLogger("toxme")
@@ -42,9 +57,26 @@ ACTION_LOOKUP    = 3
 ACTION_STATUS    = 4
 ACTION_RLOOKUP    = 5
 ACTION_SEARCH     = 6
+ACTION_BULK_LOOKUP  = 7
+ACTION_BULK_RLOOKUP = 8
 INVOKABLE_ACTIONS = {ACTION_PUBLISH, ACTION_UNPUBLISH, ACTION_LOOKUP,
-                     ACTION_STATUS, ACTION_RLOOKUP, ACTION_SEARCH}
-THROTTLE_THRESHOLD = 13
+                     ACTION_STATUS, ACTION_RLOOKUP, ACTION_SEARCH,
+                     ACTION_BULK_LOOKUP, ACTION_BULK_RLOOKUP}
+# metric labels
+ACTION_NAMES = {ACTION_PUBLISH: "publish", ACTION_UNPUBLISH: "unpublish",
+                ACTION_LOOKUP: "lookup", ACTION_STATUS: "status",
+                ACTION_RLOOKUP: "rlookup", ACTION_SEARCH: "search",
+                ACTION_BULK_LOOKUP: "bulk_lookup",
+                ACTION_BULK_RLOOKUP: "bulk_rlookup"}
+# budget: (requests, per seconds) for each address
+RATE_LIMITS = {
+    "publish": (13, 3600),
+    "lookup": (600, 60),
+    "search": (120, 60),
+}
+RATE_LIMIT_CEILING = 65536
+RATE_LIMIT_SWEEP_INTERVAL = 60 * 1000
+BULK_LIMIT = 100
 
 VALID_KEY = re.compile(r"^[A-Fa-f0-9]{64}$")
 VALID_ID  = re.compile(r"^[A-Fa-f0-9]{76}$")
@@ -54,6 +86,9 @@ DISALLOWED_NAMES = {}
 NAME_LIMIT_HARD  = 63
 BIO_LIMIT        = 1372 # fixme this should be configurable || hue hue
 
+EVENT_PRUNE_INTERVAL = 10 * 60 * 1000
+COUNT_RECONCILE_INTERVAL = 5 * 60 * 1000
+
 ENTRIES_PER_PAGE = 30
 ENTRIES_PER_SEARCH = 30
 
@@ -71,10 +106,14 @@ KEY_ENC = nacl.encoding.HexEncoder
 STORE_ENC = nacl.encoding.HexEncoder
 
 SECURE_MODE = 1
+# Precomputed shared keys for clients that republish; ~100 bytes each.
+BOX_CACHE_CEILING = 4096
 
 class CryptoCore(object):
     def __init__(self):
         """Load or initialize crypto keys."""
+        self.box_cache = cache.LRUCache(BOX_CACHE_CEILING)
+        self.created = None
         try:
             with open("key", "rb") as keys_file:
                 keys = keys_file.read()
@@ -90,17 +129,29 @@ class CryptoCore(object):
             self.pkey = kp
             self.skey = signing.SigningKey(bytes(self.pkey),
                                            nacl.encoding.RawEncoder)
+        self.created = datetime.datetime.utcfromtimestamp(
+            int(os.stat("key").st_mtime))
 
     def sign(self, uobj):
+        return self.sign_fields(uobj.name, uobj.public_key, uobj.pin,
+                                uobj.checksum)
+
+    def sign_fields(self, name, public_key, pin, checksum):
         e = nacl.encoding.HexEncoder
-        pubkey = e.decode(uobj.public_key)
-        pin = e.decode(uobj.pin) if uobj.pin else b""
-        checksum = e.decode(uobj.checksum)
-        name = uobj.name.encode("utf8")
+        pubkey = e.decode(public_key)
+        pin = e.decode(pin) if pin else b""
+        checksum = e.decode(checksum)
+        name = name.encode("utf8")
 
         text = b"".join((name, pubkey, pin, checksum))
         return self.skey.sign(text, encoder=SIGNATURE_ENC).decode("utf8")
 
+    def sign_raw(self, data):
+        return bytes(self.skey.sign(data))
+
+    hash_password = staticmethod(database.hash_password)
+    check_password = staticmethod(database.check_password)
+
     @staticmethod
     def compute_checksum(data, iv=(0, 0)):
         e = nacl.encoding.HexEncoder
@@ -117,13 +168,32 @@ class CryptoCore(object):
     def verify_key(self):
         return self.skey.verify_key.encode(KEY_ENC).decode("utf8").upper()
 
+    def box_for(self, client):
+        """A Box between our key and the raw public key client. Building
+           one costs a scalar multiplication, so they are kept."""
+        box = self.box_cache.get(client)
+        if box is cache.MISS:
+            box = public.Box(self.pkey, public.PublicKey(client))
+            self.box_cache.put(client, box)
+        return box
+
+    def box_stats(self):
+        stats = self.box_cache.stats()
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = float(stats["hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def open_box(self, client, nonce, ciphertext):
+        return self.box_for(client).decrypt(ciphertext, nonce,
+                                            nacl.encoding.RawEncoder)
+
     def dsrep_decode_name(self, client, nonce, pl):
-        box = public.Box(self.pkey, public.PublicKey(client))
+        box = self.box_for(client)
         by = box.decrypt(pl, nonce)
         return by
 
     def dsrec_encrypt_key(self, client, nonce, msg):
-        box = public.Box(self.pkey, public.PublicKey(client))
+        box = self.box_for(client)
         by = box.encrypt(msg, nonce)
         return by[24:]
 
@@ -152,18 +222,41 @@ class HTTPSPolicyEnforcer(tornado.web.RequestHandler):
 
 SIGNED_RANDOM_LENGTH = 64
 
+def sign_memorabilia(crypto_pool, envelope):
+    """A future for the signed "memorabilia" of envelope, or None if it
+       has none."""
+    if "memorabilia" in envelope and isinstance(envelope["memorabilia"], str):
+        try:
+            decoded = base64.b64decode(envelope["memorabilia"].encode('ascii'))
+            LOGGER.info(len(decoded))
+            if len(decoded) == SIGNED_RANDOM_LENGTH:
+                return crypto_pool.sign_raw(decoded)
+        except (ValueError, TypeError, KeyError, binascii.Error):
+            LOGGER.info("did fail request because random data was bad")
+    return None
+
+def is_rate_limited(settings, request, budget, cost=1):
+    """1 if request's address has spent its budget (never in sandbox
+       mode, where there is no limiter)."""
+    limiter = settings["rate_limiter"]
+    return limiter is not None and not limiter.allow(budget,
+                                                     request.remote_ip, cost)
+
 class BaseAPIHandler(tornado.web.RequestHandler):
 
     def handle_envelope_hash(self, envelope):
         self.signed_hash = None
-        if "memorabilia" in envelope and isinstance(envelope["memorabilia"], str):
+        self.pending_hash = sign_memorabilia(self.settings["crypto_pool"],
+                                             envelope)
+
+    @tornado.gen.coroutine
+    def prepare(self):
+        pending = getattr(self, "pending_hash", None)
+        if pending is not None:
             try:
-                decoded = base64.b64decode(envelope["memorabilia"].encode('ascii'))
-                LOGGER.info(len(decoded))
-                if len(decoded) == SIGNED_RANDOM_LENGTH:
-                    self.signed_hash = self.settings["crypto_core"].skey.sign(decoded)
-                    LOGGER.info(self.signed_hash)
-            except (ValueError, TypeError, KeyError, binascii.Error, nacl.exceptions.CryptoError):
+                self.signed_hash = yield pending
+                LOGGER.info(self.signed_hash)
+            except nacl.exceptions.CryptoError:
                 LOGGER.info("did fail request because random data was bad")
 
     def write_secure(self, chunk):
@@ -176,9 +269,53 @@ class BaseAPIHandler(tornado.web.RequestHandler):
                     self.signed_hash = None
         except AttributeError:
             LOGGER.info("did fail request because data was even worse")
-        
+
+        if isinstance(new_chunk, dict):
+            with tracing.phase("json"):
+                new_chunk = tornado.escape.json_encode(new_chunk)
+            self.set_header("Content-Type", "application/json; charset=UTF-8")
         self.write(new_chunk)
 
+    def write_secure_json(self, body):
+        """write_secure for a dict that is already JSON-encoded."""
+        if self.signed_hash is not None:
+            body = b"".join((body[:-1], b', "signed_memorabilia": "',
+                             base64.b64encode(self.signed_hash), b'"}'))
+            self.signed_hash = None
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(body)
+
+    def render_string(self, template_name, **kwargs):
+        with tracing.phase("render"):
+            return super(BaseAPIHandler, self).render_string(template_name,
+                                                             **kwargs)
+
+    def _is_rate_limited(self, budget, cost=1):
+        return is_rate_limited(self.settings, self.request, budget, cost)
+
+    def _is_not_modified(self, etag, last_modified=None):
+        """Set the validators on the response and return 1 (with a 304)
+           when the client's copy is current. last_modified is a UTC
+           datetime; If-Modified-Since is only consulted when the request
+           has no If-None-Match, as RFC 7232 says."""
+        self.set_header("Etag", etag)
+        if last_modified is not None:
+            self.set_header("Last-Modified", last_modified)
+        inm = self.request.headers.get("If-None-Match")
+        if inm is not None:
+            if inm.strip() == "*" or etag in (t.strip()
+                                              for t in inm.split(",")):
+                self.set_status(304)
+                return 1
+            return 0
+        ims = self.request.headers.get("If-Modified-Since")
+        if ims and last_modified is not None:
+            since = email.utils.parsedate(ims)
+            if since and last_modified <= datetime.datetime(*since[:6]):
+                self.set_status(304)
+                return 1
+        return 0
+
 class APIHandler(BaseAPIHandler):
     RETURNS_JSON = 1
 
@@ -190,6 +327,7 @@ class APIHandler(BaseAPIHandler):
                 return 0
         return 1
 
+    @tornado.gen.coroutine
     def _encrypted_payload_prologue(self, envelope):
         if not self._typecheck_dict(envelope, {"public_key": str, "nonce": str,
                                                "encrypted": str}):
@@ -205,12 +343,11 @@ class APIHandler(BaseAPIHandler):
             self.json_payload(error_codes.ERROR_BAD_PAYLOAD)
             return
 
-        box = public.Box(self.settings["crypto_core"].pkey, other_key)
-
         try:
             nonce = nacl.encoding.Base64Encoder.decode(envelope["nonce"])
             ciphertext = nacl.encoding.Base64Encoder.decode(envelope["encrypted"])
-            clear = box.decrypt(ciphertext, nonce, nacl.encoding.RawEncoder)
+            clear = yield self.settings["crypto_pool"].open_box(
+                other_key.encode(nacl.encoding.RawEncoder), nonce, ciphertext)
         except (ValueError, TypeError, nacl.exceptions.CryptoError):
             LOGGER.warn("did fail req because a base64 value was bad")
             self.set_status(400)
@@ -224,7 +361,7 @@ class APIHandler(BaseAPIHandler):
             self.set_status(400)
             self.json_payload(error_codes.ERROR_BAD_PAYLOAD)
             return
-        return clear
+        raise tornado.gen.Return(clear)
 
     def json_payload(self, payload):
         if self.RETURNS_JSON:
@@ -233,66 +370,66 @@ class APIHandler(BaseAPIHandler):
             self.render("api_error_pretty.html", payload=payload,
                         f=error_codes.DESCRIPTIONS[payload["c"]])
 
-    def update_db_entry(self, auth, name, pub, bio, check, privacy, pin=None,
-                        password=None):
+    def _store_entry(self, auth, name, pub, bio, check, privacy, pin,
+                     password, sig):
+        """Runs on the database pool. Returns an error code, or None."""
         dbc = self.settings["local_store"]
         with dbc.lock:
             session, owner_of_cid = dbc.get_by_id_ig(pub)
             if owner_of_cid and owner_of_cid.name != name:
                 session.close()
-                self.set_status(400)
-                self.json_payload(error_codes.ERROR_DUPE_ID)
-                return 0
+                return error_codes.ERROR_DUPE_ID
 
             session, mus = dbc.get_ig(name, session)
             if not mus:
                 mus = database.User()
             elif mus.public_key != auth:
                 session.close()
-                self.set_status(400)
-                self.json_payload(error_codes.ERROR_NAME_TAKEN)
-                return 0
+                return error_codes.ERROR_NAME_TAKEN
 
             mus.name = name
             mus.public_key = pub
             mus.checksum = check
             mus.privacy = privacy
             mus.timestamp = datetime.datetime.now()
-            mus.sig = self.settings["crypto_core"].sign(mus)
+            mus.sig = sig
             mus.bio = bio
             mus.pin = pin
             if password:
                 mus.password = password
             ok = dbc.update_atomic(mus, session)
-            if not ok:
-                session.close()
-                self.set_status(400)
-                self.json_payload(error_codes.ERROR_DUPE_ID)
-                return 0
             session.close()
-        return 1
+            if not ok:
+                return error_codes.ERROR_DUPE_ID
+        return None
+
+    @tornado.gen.coroutine
+    def update_db_entry(self, auth, name, pub, bio, check, privacy, pin=None,
+                        password=None):
+        sig = yield self.settings["crypto_pool"].sign_record(name, pub, pin,
+                                                             check)
+        error = yield self.settings["async_store"].run(self._store_entry,
+            auth, name, pub, bio, check, privacy, pin, password, sig)
+        if error:
+            self.set_status(400)
+            self.json_payload(error)
+            raise tornado.gen.Return(0)
+        self.settings["qr_store"].schedule("".join((pub, pin or "", check)))
+        raise tornado.gen.Return(1)
 
 class APIUpdateName(APIHandler):
     def initialize(self, envelope):
         self.envelope = envelope
         self.handle_envelope_hash(envelope)
 
+    @tornado.gen.coroutine
     def post(self):
-        if self.settings["address_ctr"]:
-            ctr = self.settings["address_ctr"][ACTION_PUBLISH]
-            if ctr["clear_date"][self.request.remote_ip] < time.time():
-                del ctr["counter"][self.request.remote_ip]
-                del ctr["clear_date"][self.request.remote_ip]
-            ctr["counter"][self.request.remote_ip] += 1
-            # Clears in one hour
-            ctr["clear_date"][self.request.remote_ip] = time.time() + 3600
-
-            if ctr["counter"][self.request.remote_ip] > THROTTLE_THRESHOLD:
-                self.set_status(400)
-                self.write_secure(error_codes.ERROR_RATE_LIMIT)
-                return
+        if self._is_rate_limited("publish"):
+            self.set_status(400)
+            self.write_secure(error_codes.ERROR_RATE_LIMIT)
+            return
 
-        clear = self._encrypted_payload_prologue(self.envelope)
+        clear = yield self._encrypted_payload_prologue(self.envelope)
         if not clear:
             return
 
@@ -332,17 +469,17 @@ class APIUpdateName(APIHandler):
 
         pub, pin, check = id_[:64], id_[64:72], id_[72:]
 
-        old_rec = self.settings["local_store"].get(name)
+        old_rec = yield self.settings["async_store"].get(name)
         if not old_rec:
-            salt = os.urandom(16)
             password = new_password()
-            hash_ = salt + hashlib.sha512(salt + password.encode("ascii")).digest()
+            hash_ = yield self.settings["crypto_pool"].hash_password(password)
         else:
             password = None
             hash_ = None
 
-        if self.update_db_entry(auth, name, pub, bio, check,
-                                max(clear["privacy"], 0), pin, hash_):
+        ok = yield self.update_db_entry(auth, name, pub, bio, check,
+                                        max(clear["privacy"], 0), pin, hash_)
+        if ok:
             ok = error_codes.ERROR_OK.copy()
             ok["password"] = password
             self.json_payload(ok)
@@ -353,8 +490,9 @@ class APIReleaseName(APIHandler):
         self.envelope = envelope
         self.handle_envelope_hash(envelope)
 
+    @tornado.gen.coroutine
     def post(self):
-        clear = self._encrypted_payload_prologue(self.envelope)
+        clear = yield self._encrypted_payload_prologue(self.envelope)
         if not clear:
             return
 
@@ -367,12 +505,114 @@ class APIReleaseName(APIHandler):
             LOGGER.warn("Invalid timestamp")
             return
 
-        rec = self.settings["local_store"].get_by_id_ig(pk)[1]
-        old = database.StaleUser(rec)
-        self.settings["local_store"].delete_pk(pk)
+        yield self.settings["async_store"].delete_pk(pk)
         self.json_payload(error_codes.ERROR_OK)
         return
 
+def lookup_result(rec, home):
+    """The ACTION_LOOKUP reply for a local record (or None)."""
+    if not rec:
+        return error_codes.ERROR_NO_USER
+    return {
+        "c": 0,
+        "name": rec.name,
+        "regdomain": home,
+        "tox_id": rec.tox_id(),
+        "url": "tox:{0}@{1}".format(rec.name, home),
+        "verify": {
+            "status": SIGNSTATUS_GOOD,
+            "detail": "Good (signed by local authority)",
+        },
+        "source": SOURCE_LOCAL,
+        "version": "Tox V3 (local)"
+    }
+
+def lookup_body(rec, home):
+    """lookup_result for a found record as ready-to-send JSON. Built once
+       per version of the record, since the cache hands out the same
+       StaleUser until the record is published again or deleted."""
+    body = rec.memo.get("lookup")
+    if body is None:
+        with tracing.phase("json"):
+            body = tornado.escape.json_encode(lookup_result(rec, home)).encode(
+                "utf8")
+        rec.memo["lookup"] = body
+    return body
+
+def rlookup_result(rec):
+    """The ACTION_RLOOKUP reply for a local record (or None)."""
+    if not rec:
+        return error_codes.ERROR_NO_USER
+    return {
+        "c": 0,
+        "name": rec.name,
+    }
+
+def split_lookup_name(name, home):
+    """Lowercased (user, domain) for a lookup name, or None if invalid."""
+    if not isinstance(name, str):
+        return None
+    name = name.lower()
+    if not name or name.endswith("@") or name.startswith("@"):
+        return None
+    if "@" not in name:
+        name = "@".join((name, home))
+    return tuple(name.rsplit("@", 1))
+
+@tornado.gen.coroutine
+def lookup_names(settings, names):
+    """lookup_result for each of names, in order, with one query for
+       whatever the cache doesn't have."""
+    home = settings["home"]
+    parts = [split_lookup_name(name, home) for name in names]
+    local = [p[0] for p in parts if p and p[1] == home]
+    recs = yield settings["async_store"].get_many(local)
+    results = []
+    for p in parts:
+        if not p:
+            results.append(error_codes.ERROR_BAD_PAYLOAD)
+        elif p[1] != home:
+            results.append(error_codes.ERROR_LOOKUP_FAILED)
+        else:
+            results.append(lookup_result(recs[p[0]], home))
+    raise tornado.gen.Return(results)
+
+@tornado.gen.coroutine
+def lookup_ids(settings, ids):
+    """rlookup_result for each of ids, like lookup_names."""
+    valid = [id.upper() for id in ids
+             if isinstance(id, str) and VALID_KEY.match(id)]
+    recs = yield settings["async_store"].get_many_by_id(valid)
+    results = []
+    for id in ids:
+        if isinstance(id, str) and VALID_KEY.match(id):
+            results.append(rlookup_result(recs[id.upper()]))
+        else:
+            results.append(error_codes.ERROR_INVALID_ID)
+    raise tornado.gen.Return(results)
+
+def search_error(name, page):
+    """The error code for a bad ACTION_SEARCH query, or None."""
+    if (type(page) is not int) or page < 0:
+        LOGGER.warn("Invalid page")
+        return error_codes.ERROR_INVALID_CHAR
+    if not isinstance(name, str) or not name:
+        LOGGER.warn("No name given")
+        return error_codes.ERROR_INVALID_NAME
+    if len(name) > NAME_LIMIT_HARD:
+        LOGGER.warn("Name too long")
+        return error_codes.ERROR_INVALID_NAME
+    return None
+
+@tornado.gen.coroutine
+def search_result(settings, name, page):
+    users = yield settings["async_store"].search_users(name.lower(),
+                                                       ENTRIES_PER_SEARCH, page)
+    raise tornado.gen.Return({
+        "c": 0,
+        "users": [{"name": user.name, "bio": user.bio} for user in users],
+    })
+
 class APILookupID(BaseAPIHandler):
     def initialize(self, envelope):
         self.envelope = envelope
@@ -383,39 +623,31 @@ class APILookupID(BaseAPIHandler):
         self.write_secure(result)
         self.finish()
 
-    def _build_local_result(self, name):
-        rec = self.settings["local_store"].get(name)
+    @tornado.gen.coroutine
+    def _send_local_result(self, name):
+        rec = yield self.settings["async_store"].get(name)
         if not rec:
-            return error_codes.ERROR_NO_USER
-        base_ret = {
-            "c": 0,
-            "name": rec.name,
-            "regdomain": self.settings["home"],
-            "tox_id": rec.tox_id(),
-            "url": "tox:{0}@{1}".format(rec.name, self.settings["home"]),
-            "verify": {
-                "status": SIGNSTATUS_GOOD,
-                "detail": "Good (signed by local authority)",
-            },
-            "source": SOURCE_LOCAL,
-            "version": "Tox V3 (local)"
-        }
-        return base_ret
+            self._results(error_codes.ERROR_NO_USER)
+            return
+        self.write_secure_json(lookup_body(rec, self.settings["home"]))
+        self.finish()
 
-    @tornado.web.asynchronous
+    @tornado.gen.coroutine
     def post(self):
-        name = self.envelope.get("name").lower()
-        if not name or name.endswith("@") or name.startswith("@"):
+        if self._is_rate_limited("lookup"):
+            self._results(error_codes.ERROR_RATE_LIMIT)
+            return
+        parts = split_lookup_name(self.envelope.get("name"),
+                                  self.settings["home"])
+        if not parts:
             self.set_status(400)
             self.write_secure(error_codes.ERROR_BAD_PAYLOAD)
             LOGGER.warn("Name invalid")
             self.finish()
             return
-        if "@" not in name:
-            name = "@".join((name, self.settings["home"]))
-        user, domain = name.rsplit("@", 1)
+        user, domain = parts
         if domain == self.settings["home"]:
-            self._results(self._build_local_result(user))
+            yield self._send_local_result(user)
             return
         else:
             LOGGER.warn("What (a) Terrible (dns-related) Failure")
@@ -430,18 +662,16 @@ class APILookupName(BaseAPIHandler):
         self.write_secure(result)
         self.finish()
 
+    @tornado.gen.coroutine
     def _build_local_result(self, id):
-        rec = self.settings["local_store"].get_by_id(id)
-        if not rec:
-            return error_codes.ERROR_NO_USER
-        base_ret = {
-            "c": 0,
-            "name": rec.name,
-        }
-        return base_ret
+        rec = yield self.settings["async_store"].get_by_id(id)
+        raise tornado.gen.Return(rlookup_result(rec))
 
-    @tornado.web.asynchronous
+    @tornado.gen.coroutine
     def post(self):
+        if self._is_rate_limited("lookup"):
+            self._results(error_codes.ERROR_RATE_LIMIT)
+            return
         id = self.envelope.get("id").lower()
         if not id:
             self.set_status(400)
@@ -456,10 +686,14 @@ class APILookupName(BaseAPIHandler):
                 LOGGER.warn("ID unknown")
                 self.finish()
                 return
-            self._results(self._build_local_result(id))
+            result = yield self._build_local_result(id)
+            self._results(result)
             return
 
-class APISearch(BaseAPIHandler):
+class APIBulkLookup(BaseAPIHandler):
+    """ACTION_BULK_LOOKUP and ACTION_BULK_RLOOKUP: up to BULK_LIMIT names
+       or keys per request, answered from the cache plus one query for
+       the misses. Results come back in request order."""
     def initialize(self, envelope):
         self.envelope = envelope
         self.handle_envelope_hash(envelope)
@@ -469,40 +703,187 @@ class APISearch(BaseAPIHandler):
         self.write_secure(result)
         self.finish()
 
-    def _build_local_result(self, name, page):
-        users = self.settings["local_store"].search_users(name, ENTRIES_PER_SEARCH, page)
-        base_ret = {
-            "c": 0,
-            "users": [{"name": user.name, "bio": user.bio} for user in users],
-        }
-        return base_ret
-
-    @tornado.web.asynchronous
+    @tornado.gen.coroutine
     def post(self):
-        name = self.envelope.get("name").lower()
-        page = self.envelope.get("page")
-
-        if (type(page) is not int) or page < 0:
+        if self.envelope["action"] == ACTION_BULK_LOOKUP:
+            items, lookup = self.envelope.get("names"), lookup_names
+        else:
+            items, lookup = self.envelope.get("ids"), lookup_ids
+        if not isinstance(items, list) or not 0 < len(items) <= BULK_LIMIT:
             self.set_status(400)
-            self.write_secure(error_codes.ERROR_INVALID_CHAR)
-            LOGGER.warn("Invalid page")
+            self.write_secure(error_codes.ERROR_BAD_PAYLOAD)
+            LOGGER.warn("Invalid bulk request")
             self.finish()
             return
+        if self._is_rate_limited("lookup", len(items)):
+            self._results(error_codes.ERROR_RATE_LIMIT)
+            return
+        results = yield lookup(self.settings, items)
+        self._results({"c": 0, "results": results})
+
+class APISearch(BaseAPIHandler):
+    def initialize(self, envelope):
+        self.envelope = envelope
+        self.handle_envelope_hash(envelope)
+
+    def _results(self, result):
+        self.set_status(200 if result["c"] == 0 else 400)
+        self.write_secure(result)
+        self.finish()
+
+    @tornado.gen.coroutine
+    def post(self):
+        name = self.envelope.get("name")
+        page = self.envelope.get("page")
 
-        if not name:
+        error = search_error(name, page)
+        if error:
             self.set_status(400)
-            self.write_secure(error_codes.ERROR_INVALID_NAME)
-            LOGGER.warn("No name given")
+            self.write_secure(error)
             self.finish()
             return
-        else:
-            if len(name) > NAME_LIMIT_HARD:
-                self.set_status(400)
-                self.write_secure(error_codes.ERROR_INVALID_NAME)
-                LOGGER.warn("Name too long")
-                self.finish()
-            self._results(self._build_local_result(name, page))
+        if self._is_rate_limited("search"):
+            self._results(error_codes.ERROR_RATE_LIMIT)
+            return
+        result = yield search_result(self.settings, name, page)
+        self._results(result)
+
+WS_MAX_INFLIGHT = 8
+WS_MAX_BACKLOG = 64
+# a tuple, not a set: "action" can be any JSON value, hashable or not
+STREAM_ACTIONS = (ACTION_LOOKUP, ACTION_RLOOKUP, ACTION_SEARCH,
+                  ACTION_BULK_LOOKUP, ACTION_BULK_RLOOKUP)
+
+class APIStream(tornado.websocket.WebSocketHandler):
+    """The anonymous /api actions over one WebSocket. Each message is an
+       /api envelope plus a "tag" chosen by the client; replies carry
+       the same tag and are sent as soon as they are ready, so they may arrive
+       out of order. A connection gets at most WS_MAX_INFLIGHT requests
+       worked on at a time and WS_MAX_BACKLOG waiting; anything past that
+       is answered with ERROR_RATE_LIMIT straight away."""
+    def check_origin(self, origin):
+        # read-only public API, same as POSTing to /api
+        return True
+
+    def open(self):
+        self.closed = 0
+        self.inflight = 0
+        self.backlog = deque()
+        if SECURE_MODE and self.request.protocol != "https":
+            self.write_message(json.dumps(error_codes.ERROR_NOTSECURE))
+            self.close()
+
+    def on_close(self):
+        self.closed = 1
+        self.backlog.clear()
+
+    def on_message(self, message):
+        try:
+            envelope = json.loads(message)
+            if not isinstance(envelope, dict):
+                raise TypeError("envelope must be an object")
+        except (TypeError, ValueError):
+            LOGGER.warn("failing stream message because of an invalid payload")
+            self._reject({}, error_codes.ERROR_BAD_PAYLOAD)
+            return
+        if len(self.backlog) >= WS_MAX_BACKLOG:
+            self._reject(envelope, error_codes.ERROR_RATE_LIMIT)
+            return
+        self.backlog.append(envelope)
+        self._pump()
+
+    def _reject(self, envelope, error):
+        # not counted against the in-flight budget; f.result() surfaces
+        # anything unexpected in the log
+        tornado.ioloop.IOLoop.current().add_future(
+            self._send(envelope, error), lambda f: f.result())
+
+    def _pump(self):
+        while self.backlog and self.inflight < WS_MAX_INFLIGHT:
+            self.inflight += 1
+            envelope = self.backlog.popleft()
+            if self.settings["slow_request_ms"]:
+                trace = tracing.Trace()
+                with tracing.activate(trace):
+                    answer = self._answer(envelope)
+            else:
+                trace, answer = None, self._answer(envelope)
+            tornado.ioloop.IOLoop.current().add_future(answer,
+                functools.partial(self._answered, envelope, trace, time.time()))
+
+    def _answered(self, envelope, trace, start, future):
+        self.inflight -= 1
+        try:
+            seconds = time.time() - start
+            action = action_label(envelope)
+            registry = self.settings["metrics"]
+            if registry:
+                registry.observe("stream_message_seconds", seconds,
+                                 action=action)
+            if trace and seconds * 1000 >= self.settings["slow_request_ms"]:
+                log_slow(trace, seconds, route=self.__class__.__name__,
+                         action=action)
+            try:
+                future.result()
+            except Exception:
+                LOGGER.exception("stream message failed")
+                self._reject(envelope, error_codes.ERROR_LOOKUP_INTERNAL)
+        finally:
+            self._pump()
+
+    @tornado.gen.coroutine
+    def _answer(self, envelope):
+        action = envelope.get("action")
+        if action not in STREAM_ACTIONS:
+            yield self._send(envelope, error_codes.ERROR_BAD_PAYLOAD)
             return
+        budget, cost = "search" if action == ACTION_SEARCH else "lookup", 1
+        if action in (ACTION_BULK_LOOKUP, ACTION_BULK_RLOOKUP):
+            items = envelope.get("names" if action == ACTION_BULK_LOOKUP
+                                 else "ids")
+            cost = len(items) if isinstance(items, list) else 1
+        if is_rate_limited(self.settings, self.request, budget, cost):
+            result = error_codes.ERROR_RATE_LIMIT
+        elif action == ACTION_LOOKUP:
+            results = yield lookup_names(self.settings,
+                                         [envelope.get("name")])
+            result = results[0]
+        elif action == ACTION_RLOOKUP:
+            results = yield lookup_ids(self.settings, [envelope.get("id")])
+            result = results[0]
+        elif action == ACTION_SEARCH:
+            name, page = envelope.get("name"), envelope.get("page")
+            result = search_error(name, page)
+            if not result:
+                result = yield search_result(self.settings, name, page)
+        elif action in (ACTION_BULK_LOOKUP, ACTION_BULK_RLOOKUP):
+            key, lookup = (("names", lookup_names)
+                           if action == ACTION_BULK_LOOKUP
+                           else ("ids", lookup_ids))
+            items = envelope.get(key)
+            if isinstance(items, list) and 0 < len(items) <= BULK_LIMIT:
+                results = yield lookup(self.settings, items)
+                result = {"c": 0, "results": results}
+            else:
+                result = error_codes.ERROR_BAD_PAYLOAD
+        yield self._send(envelope, result)
+
+    @tornado.gen.coroutine
+    def _send(self, envelope, result):
+        reply = dict(result)
+        reply["tag"] = envelope.get("tag")
+        pending = sign_memorabilia(self.settings["crypto_pool"], envelope)
+        if pending is not None:
+            try:
+                signed = yield pending
+                reply["signed_memorabilia"] = str(base64.b64encode(signed),
+                                                  'ascii')
+            except nacl.exceptions.CryptoError:
+                LOGGER.info("did fail request because random data was bad")
+        if not self.closed:
+            with tracing.phase("json"):
+                reply = json.dumps(reply)
+            self.write_message(reply)
 
 class APIStatus(BaseAPIHandler):
     def initialize(self, envelope):
@@ -520,13 +901,14 @@ class APIStatus(BaseAPIHandler):
         n += random.randint(-100, 100)
         return max(0, n if not n % 100 else n + 100 - n % 100)
 
-    @tornado.web.asynchronous
+    @tornado.gen.coroutine
     def post(self):
+        user_count = yield self.settings["async_store"].count_users()
         self._results({
             "c": 0,
             "ut": int(time.time()) - self.settings["app_startup"],
             "rs": self.fuzz(self.settings["local_store"].requests_serviced),
-            "uc": self.fuzz(self.settings["local_store"].count_users()),
+            "uc": self.fuzz(user_count),
         })
 
 class APIFailure(APIHandler):
@@ -570,22 +952,25 @@ def _make_handler_for_api_method(application, request, **kwargs):
         return APILookupName(application, request, envelope=envelope)
     elif action == ACTION_SEARCH:
         return APISearch(application, request, envelope=envelope)
+    elif action in (ACTION_BULK_LOOKUP, ACTION_BULK_RLOOKUP):
+        return APIBulkLookup(application, request, envelope=envelope)
 
 class PublicKey(BaseAPIHandler):
     def get(self):
         if SECURE_MODE:
             if self.request.protocol != "https":
                 self.write_secure(error_codes.ERROR_NOTSECURE)
-            else:
-                self.write_secure({
-                    "c": 0,
-                    "key": self.settings["crypto_core"].public_key
-                })
-        else:
-            self.write_secure({
-                "c": 0,
-                "key": self.settings["crypto_core"].public_key
-            })
+                return
+        crypto_core = self.settings["crypto_core"]
+        # the key only changes if the key file is replaced
+        self.set_header("Cache-Control", "public, max-age=3600")
+        if self._is_not_modified('"{0}"'.format(crypto_core.public_key),
+                                 crypto_core.created):
+            return
+        self.write_secure({
+            "c": 0,
+            "key": crypto_core.public_key
+        })
 
 
 class CreateQR(BaseAPIHandler):
@@ -593,6 +978,7 @@ class CreateQR(BaseAPIHandler):
         self.set_status(404)
         return
 
+    @tornado.gen.coroutine
     def get(self, path_id):
         if SECURE_MODE:
             if self.request.protocol != "https":
@@ -601,15 +987,88 @@ class CreateQR(BaseAPIHandler):
         name = (parse.unquote(path_id) if path_id else "").lower()
         if not name or not set(name).isdisjoint(DISALLOWED_CHARS):
             return self._fail()
-        rec = self.settings["local_store"].get(name)
+        rec = yield self.settings["async_store"].get(name)
         if not rec:
             return self._fail()
 
-        self.set_header("Cache-Control", "public; max-age=86400")
+        self.set_header("Cache-Control", "public, max-age=86400")
+        if self._is_not_modified(barcode.QRImage.etag(rec.tox_id())):
+            return
         self.set_header("Content-Type", "image/svg+xml; charset=utf-8")
-        self.write_secure(barcode.QRImage.get(self.settings["local_store"].get(name).tox_id()))
+        svg = yield self.settings["qr_store"].get(rec.tox_id())
+        self.write_secure(svg)
         return
 
+PROFILE_TEMPLATE = "onemomentplease.html"
+LISTING_TEMPLATE = "public_userlist.html"
+PAGE_CACHE_BYTES = 8 * 1024 * 1024
+# bump when the templates change, so clients drop pages they validated
+PAGE_RENDER_VERSION = 1
+# shared caches may keep pages but must check them with us every time
+PAGE_CACHE_CONTROL = "public, no-cache"
+
+def http_timestamp(timestamp):
+    """A record timestamp (naive local time) as a UTC datetime, to the
+       second, for Last-Modified."""
+    return datetime.datetime.utcfromtimestamp(
+        int(time.mktime(timestamp.timetuple())))
+
+def profile_validators(rec):
+    """(ETag, Last-Modified) of rec's profile page. Every write to a
+       record sets its timestamp, so the timestamp versions the page."""
+    text = "{0}:{1}:{2}".format(PAGE_RENDER_VERSION, rec.name,
+                                rec.timestamp.isoformat())
+    return ('"{0}"'.format(hashlib.sha1(text.encode("utf8")).hexdigest()),
+            http_timestamp(rec.timestamp))
+
+def listing_etag(num, after, results):
+    """ETag of a directory page: the rows it shows and where it sits.
+       It has no Last-Modified, because a delete can change a page
+       without making any of its rows newer."""
+    digest = hashlib.sha1("{0}:{1}:{2}".format(
+        PAGE_RENDER_VERSION, num, after).encode("utf8"))
+    for rec in results:
+        digest.update("|{0}:{1}".format(
+            rec.user_id, rec.timestamp.isoformat()).encode("utf8"))
+    return '"{0}"'.format(digest.hexdigest())
+
+class PageCache(object):
+    """Rendered /u and /friends pages, one LRU per template. A profile is
+       dropped when its record is written, and the directory listing on
+       any write. A page is only kept if no write happened while it was
+       being built, which is checked against the database generation the
+       same way the database guards its own caches."""
+    def __init__(self, db, capacity=PAGE_CACHE_BYTES):
+        self.db = db
+        weigh = lambda entry: len(entry[0])
+        self.stores = {
+            PROFILE_TEMPLATE: cache.LRUCache(capacity // 2, weigh=weigh),
+            LISTING_TEMPLATE: cache.LRUCache(capacity // 2, weigh=weigh),
+        }
+        db.write_hooks.append(self._written)
+
+    def _written(self, names):
+        for name in names:
+            self.stores[PROFILE_TEMPLATE].discard((name,))
+        self.stores[LISTING_TEMPLATE].clear()
+
+    def generation(self):
+        """Take this before reading what a page is built from."""
+        return self.db.generation
+
+    def get(self, template, *key):
+        return self.stores[template].get(key, None)
+
+    def put(self, template, entry, generation, *key):
+        """Keep entry, a (page, etag, last modified) tuple."""
+        with self.db.cache_lock:
+            if generation == self.db.generation:
+                self.stores[template].put(key, entry)
+
+    def stats(self):
+        return {template: store.stats()
+                for template, store in self.stores.items()}
+
 class LookupAndOpenUser(BaseAPIHandler):
     def _user_id(self):
         spl = self.request.host.rsplit(".", 1)[0]
@@ -618,6 +1077,7 @@ class LookupAndOpenUser(BaseAPIHandler):
         else:
             return spl
 
+    @tornado.gen.coroutine
     def _render_open_user(self, name):
         if not name or not set(name).isdisjoint(DISALLOWED_CHARS):
             self.set_status(404)
@@ -625,19 +1085,34 @@ class LookupAndOpenUser(BaseAPIHandler):
                         realm=self.settings["home"])
             return
 
-        rec = self.settings["local_store"].get(name)
-        if not rec:
-            self.set_status(404)
-            self.render("fourohfour.html", record=name,
-                        realm=self.settings["home"])
-            return
+        page_cache = self.settings["page_cache"]
+        entry = page_cache.get(PROFILE_TEMPLATE, name)
+        if entry is None:
+            generation = page_cache.generation()
+            rec = yield self.settings["async_store"].get(name)
+            if not rec:
+                self.set_status(404)
+                self.render("fourohfour.html", record=name,
+                            realm=self.settings["home"])
+                return
+            validators = profile_validators(rec)
+        else:
+            validators = entry[1:]
 
-        self.render("onemomentplease.html", record=rec,
-                    realm=self.settings["home"])
+        self.set_header("Cache-Control", PAGE_CACHE_CONTROL)
+        if self._is_not_modified(*validators):
+            return
+        if entry is None:
+            entry = (self.render_string(PROFILE_TEMPLATE, record=rec,
+                                        realm=self.settings["home"]),
+                     ) + validators
+            page_cache.put(PROFILE_TEMPLATE, entry, generation, name)
+        self.finish(entry[0])
 
     def _lookup_home(self):
         self.render("lookup_home.html")
 
+    @tornado.gen.coroutine
     def get(self, path_id=None):
         if SECURE_MODE:
             if self.request.protocol != "https":
@@ -645,33 +1120,61 @@ class LookupAndOpenUser(BaseAPIHandler):
                 return
         name = (parse.unquote(path_id) if path_id else "").lower()
         if name:
-            return self._render_open_user(name)
+            yield self._render_open_user(name)
         else:
-            return self._lookup_home()
+            self._lookup_home()
 
 class FindFriends(BaseAPIHandler):
+    @tornado.gen.coroutine
     def _render_page(self, num):
         num = int(num)
-        results = self.settings["local_store"].get_page(num,
-                                                        ENTRIES_PER_PAGE)
-        if not results:
-            self.set_status(404)
-            self.render("fourohfour.html", record="",
-                        realm=self.settings["home"])
-            return
-        self.render("public_userlist.html", results_set=results,
-                    realm=self.settings["home"],
-                    next_page=(None if len(results) < ENTRIES_PER_PAGE
-                                    else num + 1),
-                    previous_page=(num - 1) if num > 0 else None)
+        after = database.decode_cursor(self.get_argument("after", ""))
+        page_cache = self.settings["page_cache"]
+        entry = page_cache.get(LISTING_TEMPLATE, num, after)
+        if entry is None:
+            generation = page_cache.generation()
+            store = self.settings["async_store"]
+            results = None
+            if not after:
+                # the count is cached, so a page number past the end costs
+                # no query; one page of slack covers other workers' publishes
+                # that the count hasn't caught up with
+                pages = yield store.count_pages(ENTRIES_PER_PAGE)
+                if num > pages:
+                    results = []
+            if results is None:
+                results = yield store.get_page(num, ENTRIES_PER_PAGE, after)
+            if not results:
+                self.set_status(404)
+                self.render("fourohfour.html", record="",
+                            realm=self.settings["home"])
+                return
+            etag = listing_etag(num, after, results)
+        else:
+            etag = entry[1]
 
+        self.set_header("Cache-Control", PAGE_CACHE_CONTROL)
+        if self._is_not_modified(etag):
+            return
+        if entry is None:
+            entry = (self.render_string(LISTING_TEMPLATE, results_set=results,
+                        realm=self.settings["home"],
+                        next_page=(None if len(results) < ENTRIES_PER_PAGE
+                                        else num + 1),
+                        next_cursor=database.encode_cursor(results[-1]),
+                        previous_page=(num - 1) if num > 0 else None),
+                     etag, None)
+            page_cache.put(LISTING_TEMPLATE, entry, generation, num, after)
+        self.finish(entry[0])
+
+    @tornado.gen.coroutine
     def get(self, page):
         if SECURE_MODE:
             if self.request.protocol != "https":
                 self.write_secure(error_codes.ERROR_NOTSECURE)
                 return
 
-        return self._render_page(page)
+        yield self._render_page(page)
 
 class EditKeyWeb(APIHandler):
     RETURNS_JSON = 0
@@ -683,30 +1186,24 @@ class EditKeyWeb(APIHandler):
                 return
         self.render("edit_ui.html")
 
+    @tornado.gen.coroutine
     def post(self):
         if SECURE_MODE:
             if self.request.protocol != "https":
                 self.json_payload(error_codes.ERROR_NOTSECURE)
                 return
 
-        if self.settings["address_ctr"]:
-            ctr = self.settings["address_ctr"][ACTION_PUBLISH]
-            if ctr["clear_date"][self.request.remote_ip] < time.time():
-                del ctr["counter"][self.request.remote_ip]
-                del ctr["clear_date"][self.request.remote_ip]
-            ctr["counter"][self.request.remote_ip] += 1
-            # Clears in one hour
-            ctr["clear_date"][self.request.remote_ip] = time.time() + 3600
-
-            if ctr["counter"][self.request.remote_ip] > THROTTLE_THRESHOLD:
-                self.set_status(400)
-                self.json_payload(error_codes.ERROR_RATE_LIMIT)
-                return
+        if self._is_rate_limited("publish"):
+            self.set_status(400)
+            self.json_payload(error_codes.ERROR_RATE_LIMIT)
+            return
 
         name = self.get_body_argument("name", "").lower()
         password = self.get_body_argument("password", "").lower()
-        rec = self.settings["local_store"].get(name)
-        if not (rec and rec.is_password_matching(password)):
+        rec = yield self.settings["async_store"].get(name)
+        matching = rec and (yield self.settings["crypto_pool"].check_password(
+            rec.password, password))
+        if not matching:
             self.set_status(400)
             self.json_payload(error_codes.ERROR_BAD_PASSWORD)
             return
@@ -718,7 +1215,7 @@ class EditKeyWeb(APIHandler):
             LOGGER.warn("Invalid action")
             return
         elif action == "Delete":
-            self.settings["local_store"].delete_pk(rec.public_key)
+            yield self.settings["async_store"].delete_pk(rec.public_key)
             self.redirect("/friends/0")
             return
 
@@ -746,7 +1243,9 @@ class EditKeyWeb(APIHandler):
             LOGGER.warn("Invalid checksum")
             return
 
-        if self.update_db_entry(rec.public_key, name, pkey, bio, check, privacy, pin):
+        ok = yield self.update_db_entry(rec.public_key, name, pkey, bio,
+                                        check, privacy, pin)
+        if ok:
             self.redirect("/friends/0")
         return
 
@@ -760,24 +1259,17 @@ class AddKeyWeb(APIHandler):
                 return
         self.render("add_ui.html")
 
+    @tornado.gen.coroutine
     def post(self):
         if SECURE_MODE:
             if self.request.protocol != "https":
                 self.json_payload(error_codes.ERROR_NOTSECURE)
                 return
 
-        if self.settings["address_ctr"]:
-            ctr = self.settings["address_ctr"][ACTION_PUBLISH]
-            if ctr["clear_date"][self.request.remote_ip] < time.time():
-                del ctr["counter"][self.request.remote_ip]
-                del ctr["clear_date"][self.request.remote_ip]
-            ctr["counter"][self.request.remote_ip] += 1
-            # Clears in one hour
-            ctr["clear_date"][self.request.remote_ip] = time.time() + 3600
-
-            if ctr["counter"][self.request.remote_ip] > THROTTLE_THRESHOLD:
-                self.set_status(400)
-                return
+        if self._is_rate_limited("publish"):
+            self.set_status(400)
+            self.json_payload(error_codes.ERROR_RATE_LIMIT)
+            return
 
         name = self.get_body_argument("name", "").lower()
         if (not DISALLOWED_CHARS.isdisjoint(set(name))
@@ -812,12 +1304,12 @@ class AddKeyWeb(APIHandler):
             LOGGER.warn("Checksum error")
             return
 
-        old_rec = self.settings["local_store"].get(name)
+        old_rec = yield self.settings["async_store"].get(name)
         if not old_rec:
             if lock == 0:
-                salt = os.urandom(16)
                 password = new_password()
-                hash_ = salt + hashlib.sha512(salt + password.encode("utf8")).digest()
+                hash_ = yield self.settings["crypto_pool"].hash_password(
+                    password)
             else:
                 password = "None set"
                 hash_ = None
@@ -826,8 +1318,9 @@ class AddKeyWeb(APIHandler):
             self.json_payload(error_codes.ERROR_NAME_TAKEN)
             return
 
-        if self.update_db_entry(None, name, pkey, bio, check, privacy, pin,
-                                hash_):
+        ok = yield self.update_db_entry(None, name, pkey, bio, check, privacy,
+                                        pin, hash_)
+        if ok:
             self.render("addkeyweb_success.html", n=name, p=password,
                         regdomain=self.settings["home"])
         return
@@ -843,49 +1336,22 @@ def main():
     except:
         SECURE_MODE = 1
 
-    ioloop = tornado.ioloop.IOLoop.instance()
+    # Everything up to fork_processes runs once, in the parent: the key file
+    # must exist before workers read it, and the listening socket is bound
+    # while we may still be root.
     crypto_core = CryptoCore()
-    local_store = database.Database(cfg["database_url"])
-
-    # an interesting object structure
-    if cfg["sandbox"] == 0:
-        address_ctr = {ACTION_PUBLISH: {"counter": Counter(),
-                                        "clear_date": defaultdict(lambda: 0)}}
-    else:
-        LOGGER.info("Running in sandbox mode, limits are disabled.")
-        address_ctr = None
-
     LOGGER.info("API public key: {0}".format(crypto_core.public_key))
     LOGGER.info("Record sign key: {0}".format(crypto_core.verify_key))
 
-    templates_dir = "../templates/" + cfg["templates"]
-    handlers = [
-        ("/api", _make_handler_for_api_method),
-        ("/pk", PublicKey),
-        (r"/barcode/(.+)\.svg$", CreateQR),
-        (r"/u/(.+)?$", LookupAndOpenUser),
-        (r"^/$", LookupAndOpenUser)
-    ]
-    if cfg["findfriends_enabled"]:
-        handlers.append((r"/friends/([0-9]+)$", FindFriends))
-        handlers.append((r"/add_ui", AddKeyWeb))
-        handlers.append((r"/edit_ui", EditKeyWeb))
-    app = tornado.web.Application(
-        handlers,
-        template_path=os.path.join(os.path.dirname(__file__), templates_dir),
-        static_path=os.path.join(os.path.dirname(__file__), "../static"),
-        crypto_core=crypto_core,
-        local_store=local_store,
-        address_ctr=address_ctr,
-        hooks_state=None,
-        app_startup=int(time.time()),
-        home=cfg["registration_domain"],
-    )
-    server = tornado.httpserver.HTTPServer(app, **{
-        "ssl_options": cfg.get("ssl_options"),
-        "xheaders": cfg.get("is_proxied")
-    })
-    server.listen(cfg["server_port"], cfg["server_addr"])
+    workers = cfg.get("number_of_workers", 1)
+    if workers <= 0:
+        workers = tornado.process.cpu_count()
+    sockets = tornado.netutil.bind_sockets(cfg["server_port"],
+                                           cfg["server_addr"])
+    dns_sockets = []
+    if cfg.get("dns_port"):
+        dns_sockets = dns_server.bind_sockets(
+            cfg["dns_port"], cfg.get("dns_addr", cfg["server_addr"]))
 
     if "suid" in cfg:
         LOGGER.info("Descending...")
@@ -918,19 +1384,296 @@ def main():
             SECURE_MODE = opt
     LOGGER.info("secure mode is " + str(SECURE_MODE))
 
-    local_store.late_init()
+    # create tables once, rather than racing each other in every worker
+    database.Database(cfg["database_url"], should_echo=0,
+                      pragmas=cfg.get("sqlite_pragmas")).create_schema(
+        LOGGER.info)
 
     if "pid_file" in cfg:
         with open(cfg["pid_file"], "w") as pid:
             pid.write(str(os.getpid()))
-    LOGGER.info("Notice: listening on {0}:{1}".format(
-        cfg["server_addr"], cfg["server_port"]
+    LOGGER.info("Notice: listening on {0}:{1} with {2} worker(s)".format(
+        cfg["server_addr"], cfg["server_port"], workers
     ))
+    if dns_sockets:
+        LOGGER.info("Notice: answering DNS for _tox.{0} on {1}:{2}".format(
+            cfg["registration_domain"],
+            cfg.get("dns_addr", cfg["server_addr"]), cfg["dns_port"]))
 
     try:
-        ioloop.start()
+        if workers > 1:
+            # SIGTERM unwinds the parent through the finally below; the
+            # workers notice they were orphaned and stop on their own
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            # the parent stays here supervising; only workers return
+            tornado.process.fork_processes(workers)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        serve(cfg, crypto_core, sockets, workers, dns_sockets)
     finally:
-        os.remove(cfg["pid_file"])
+        # workers leave the pid file to the parent
+        if tornado.process.task_id() is None and "pid_file" in cfg:
+            os.remove(cfg["pid_file"])
+
+def serve(cfg, crypto_core, sockets, workers, dns_sockets=()):
+    """Set up the per-process state and run the IOLoop."""
+    ioloop = tornado.ioloop.IOLoop.instance()
+    local_store = database.Database(cfg["database_url"],
+        pool=cfg.get("database_pool"),
+        pragmas=cfg.get("sqlite_pragmas"),
+        replicas=cfg.get("database_replicas", ()),
+        replica_lag=cfg.get("replica_lag", database.REPLICA_LAG))
+    crypto = crypto_pool.CryptoPool(crypto_core,
+                                    cfg.get("crypto_processes", 2),
+                                    list(sockets) + list(dns_sockets))
+    # before any thread pools exist
+    crypto.start()
+
+    if cfg["sandbox"] == 0:
+        # each worker only sees the requests the kernel hands it, so it
+        # gets an even share of every per-address budget
+        budgets = dict(RATE_LIMITS, **cfg.get("rate_limits", {}))
+        rate_limiter = ratelimit.RateLimiter(
+            {budget: (max(1, limit // workers), period)
+             for budget, (limit, period) in budgets.items()},
+            cfg.get("rate_limit_addresses", RATE_LIMIT_CEILING))
+    else:
+        LOGGER.info("Running in sandbox mode, limits are disabled.")
+        rate_limiter = None
+
+    templates_dir = "../templates/" + cfg["templates"]
+    handlers = [
+        ("/api", _make_handler_for_api_method),
+        ("/api/stream", APIStream),
+        ("/pk", PublicKey),
+        (r"/barcode/(.+)\.svg$", CreateQR),
+        (r"/u/(.+)?$", LookupAndOpenUser),
+        (r"^/$", LookupAndOpenUser)
+    ]
+    if cfg["findfriends_enabled"]:
+        handlers.append((r"/friends/([0-9]+)$", FindFriends))
+        handlers.append((r"/add_ui", AddKeyWeb))
+        handlers.append((r"/edit_ui", EditKeyWeb))
+    app = tornado.web.Application(
+        handlers,
+        template_path=os.path.join(os.path.dirname(__file__), templates_dir),
+        static_path=os.path.join(os.path.dirname(__file__), "../static"),
+        crypto_core=crypto_core,
+        crypto_pool=crypto,
+        local_store=local_store,
+        page_cache=PageCache(local_store),
+        async_store=database.AsyncDatabase(local_store,
+                                           cfg.get("database_threads", 4)),
+        qr_store=barcode.QRStore(cfg.get("qr_store", "qr_store")),
+        rate_limiter=rate_limiter,
+        metrics=metrics.Registry() if cfg.get("metrics_port") else None,
+        slow_request_ms=cfg.get("slow_request_ms", 0),
+        log_function=log_request,
+        hooks_state=None,
+        app_startup=int(time.time()),
+        home=cfg["registration_domain"],
+    )
+    server = tornado.httpserver.HTTPServer(
+        tracing.traced(app) if app.settings["slow_request_ms"] else app, **{
+        "ssl_options": cfg.get("ssl_options"),
+        "xheaders": cfg.get("is_proxied")
+    })
+    server.add_sockets(sockets)
+
+    if tornado.process.task_id() is not None:
+        parent = os.getppid()
+        def check_parent():
+            if os.getppid() != parent:
+                LOGGER.info("Supervisor went away, stopping worker.")
+                ioloop.stop()
+        tornado.ioloop.PeriodicCallback(check_parent, 1000).start()
+
+    if rate_limiter:
+        tornado.ioloop.PeriodicCallback(rate_limiter.sweep,
+                                        RATE_LIMIT_SWEEP_INTERVAL).start()
+    if cfg.get("profile_interval"):
+        profiler = tracing.SamplingProfiler(cfg["profile_interval"] / 1000.0,
+            "{0}.{1}.folded".format(cfg.get("profile_output", "profile"),
+                                    os.getpid()))
+        profiler.start()
+    local_store.late_init()
+    if app.settings["slow_request_ms"]:
+        for engine in local_store.engines():
+            tracing.instrument_engine(engine)
+    if app.settings["metrics"]:
+        serve_metrics(cfg, app.settings)
+    if dns_sockets:
+        dns_server.start(dns_server.Responder(local_store,
+            app.settings["async_store"], cfg["registration_domain"],
+            cfg.get("dns_ttl", dns_server.TTL), cfg.get("dns_nameserver"),
+            app.settings["metrics"]), dns_sockets)
+    # the user counters follow our own writes; this catches everyone else's
+    tornado.ioloop.PeriodicCallback(app.settings["async_store"].reconcile_counts,
+                                    COUNT_RECONCILE_INTERVAL).start()
+    watch_events(app.settings["async_store"],
+                 cfg.get("invalidation_interval", 1000))
+    ioloop.start()
+
+def watch_events(async_store, interval):
+    """Poll record_events so writes made by other workers (or other
+       hosts sharing the database) evict our cached copies."""
+    if not interval:
+        return
+    pending = []
+
+    def done(future):
+        pending.remove(future)
+        if future.exception():
+            LOGGER.warn("event poll failed: {0}".format(future.exception()))
+
+    def poll():
+        if pending:
+            return
+        future = async_store.poll_events()
+        pending.append(future)
+        future.add_done_callback(done)
+
+    tornado.ioloop.PeriodicCallback(poll, interval).start()
+    tornado.ioloop.PeriodicCallback(async_store.prune_events,
+                                    EVENT_PRUNE_INTERVAL).start()
+
+def log_request(handler):
+    """Tornado's access log line, plus the request metrics if enabled."""
+    status = handler.get_status()
+    seconds = handler.request.request_time()
+    if status < 400:
+        log_method = tornado.log.access_log.info
+    elif status < 500:
+        log_method = tornado.log.access_log.warning
+    else:
+        log_method = tornado.log.access_log.error
+    log_method("%d %s %.2fms", status, handler._request_summary(),
+               1000.0 * seconds)
+
+    envelope = getattr(handler, "envelope", None) or {}
+    labels = {
+        "route": handler.__class__.__name__,
+        "action": action_label(envelope),
+    }
+    registry = handler.settings.get("metrics")
+    if registry:
+        registry.inc("requests_total", status=status, **labels)
+        registry.observe("request_seconds", seconds, **labels)
+    trace = getattr(handler.request, "trace", None)
+    if trace and seconds * 1000 >= handler.settings["slow_request_ms"]:
+        log_slow(trace, seconds, status=status, **labels)
+
+def action_label(envelope):
+    """The metrics label for envelope's action; "" for anything else. The
+       action can be any JSON value, lists included, so check before
+       hashing it."""
+    action = envelope.get("action")
+    return ACTION_NAMES.get(action, "") if isinstance(action, int) else ""
+
+def log_slow(trace, seconds, **labels):
+    """Log where a slow request's time went, as one line of JSON."""
+    report = dict(labels, ms=round(seconds * 1000, 2),
+                  phases=trace.breakdown())
+    LOGGER.warn("slow request: {0}".format(json.dumps(report,
+                                                      sort_keys=True)))
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        allow = self.settings["allow"]
+        token = self.settings["token"]
+        supplied = self.request.headers.get("Authorization", "")
+        if (self.request.remote_ip not in allow or
+                (token and not hmac.compare_digest(
+                    supplied.encode("utf8"),
+                    "Bearer {0}".format(token).encode("utf8")))):
+            raise tornado.web.HTTPError(403)
+        self.set_header("Content-Type", metrics.CONTENT_TYPE)
+        self.set_header("Cache-Control", "no-store")
+        self.write(self.settings["registry"].render())
+
+def serve_metrics(cfg, settings):
+    """Instrument this worker and serve its metrics on its own listener,
+       at metrics_port plus the worker's number; scrape each worker."""
+    registry = settings["metrics"]
+    local_store = settings["local_store"]
+    registry.describe("requests_total", "counter",
+                      "HTTP requests by route, API action and status.")
+    registry.describe("request_seconds", "histogram",
+                      "HTTP request latency by route and API action.")
+    registry.describe("stream_message_seconds", "histogram",
+                      "/api/stream message latency by API action.")
+    registry.describe("rate_limit_addresses", "gauge",
+                      "Addresses tracked by each rate limit budget.")
+    registry.describe("rate_limit_rejects_total", "counter",
+                      "Requests refused by each rate limit budget.")
+    registry.describe("rate_limit_evictions_total", "counter",
+                      "Addresses forgotten to stay under rate_limit_addresses.")
+    registry.describe("users", "gauge", "Published records.")
+    registry.describe("searchable_users", "gauge",
+                      "Published records listed in the directory.")
+    registry.describe("search_index_names", "gauge",
+                      "Names held by the search index.")
+    registry.describe("lookups_total", "counter",
+                      "Name lookups answered by this worker.")
+    registry.describe("dns_queries_total", "counter",
+                      "DNS queries answered, by rcode.")
+    metrics.describe_caches(registry)
+    for engine in local_store.engines():
+        metrics.instrument_engine(registry, engine)
+
+    def caches():
+        samples = []
+        for name, stats in local_store.cache_stats().items():
+            samples.extend(metrics.cache_samples(name, stats))
+        samples.extend(metrics.cache_samples(
+            "qr", barcode.QRImage.YUU_CACHE.stats()))
+        samples.extend(metrics.cache_samples(
+            "box", settings["crypto_pool"].box_stats()))
+        for name, template in (("profile_page", PROFILE_TEMPLATE),
+                               ("listing_page", LISTING_TEMPLATE)):
+            samples.extend(metrics.cache_samples(
+                name, settings["page_cache"].stats()[template]))
+        return samples
+
+    def rate_limits():
+        limiter = settings["rate_limiter"]
+        if not limiter:
+            return []
+        samples = [("rate_limit_evictions_total", {}, limiter.evictions)]
+        for budget, stats in limiter.stats().items():
+            samples.append(("rate_limit_addresses", {"budget": budget},
+                            stats["size"]))
+            samples.append(("rate_limit_rejects_total", {"budget": budget},
+                            stats["rejects"]))
+        return samples
+
+    def records():
+        samples = [
+            ("search_index_names", {}, len(local_store.search_index)),
+            ("lookups_total", {}, local_store.requests_serviced),
+        ]
+        # None until the first count has been taken
+        if local_store.user_count is not None:
+            samples.append(("users", {}, local_store.user_count))
+            samples.append(("searchable_users", {},
+                            local_store.searchable_count))
+        return samples
+
+    for collect in (caches, rate_limits, records):
+        registry.add_collector(collect)
+
+    port = cfg["metrics_port"] + (tornado.process.task_id() or 0)
+    app = tornado.web.Application([("/metrics", MetricsHandler)],
+        registry=registry,
+        allow=set(cfg.get("metrics_allow", ["127.0.0.1", "::1"])),
+        token=cfg.get("metrics_token"),
+        # scrapes would otherwise flood the access log
+        log_function=lambda handler: None,
+    )
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(tornado.netutil.bind_sockets(
+        port, cfg.get("metrics_addr", "127.0.0.1")))
+    LOGGER.info("Serving metrics on {0}:{1}".format(
+        cfg.get("metrics_addr", "127.0.0.1"), port))
 
 if __name__ == "__main__":
     main()
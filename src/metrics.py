@@ -0,0 +1,189 @@
+"""
+* metrics.py
+* Further licensing information: see LICENSE.
+"""
+import threading
+import time
+import bisect
+
+"""
+Module summary: in-process counters and latency histograms, rendered in
+the Prometheus text format (version 0.0.4).
+
+Each web worker has its own Registry; scrape every worker.
+"""
+
+# seconds; the upper bound of each histogram bucket
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def _labels(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+def _escape(value):
+    return (str(value).replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(k, _escape(v))
+                          for k, v in labels) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+class Registry(object):
+    """Counters and histograms recorded as things happen, plus collectors:
+       functions called at scrape time that return (name, labels, value)
+       samples for state that is cheaper to read than to track, such as
+       cache sizes. Every metric must be described before use."""
+    def __init__(self, prefix="toxme_"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.kinds = {}
+        self.help = {}
+        # (name, labels) -> value, or [bucket counts, sum, count]
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def describe(self, name, kind, text):
+        """kind is counter, gauge or histogram."""
+        self.kinds[name] = kind
+        self.help[name] = text
+
+    def add_collector(self, collect):
+        self.collectors.append(collect)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, _labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _labels(labels))
+        slot = bisect.bisect_left(BUCKETS, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+            if slot < len(BUCKETS):
+                histogram[0][slot] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def time(self, name, **labels):
+        """Context manager that observes how long its block took."""
+        return _Timer(self, name, labels)
+
+    def samples(self):
+        """Every sample as (metric, series, labels, value), collectors
+           included. Histograms are expanded into their _bucket, _sum and
+           _count series."""
+        with self.lock:
+            counters = list(self.counters.items())
+            histograms = [(key, (list(h[0]), h[1], h[2]))
+                          for key, h in self.histograms.items()]
+        out = [(name, name, labels, value)
+               for (name, labels), value in counters]
+        for (name, labels), (buckets, total, count) in histograms:
+            running = 0
+            for bound, n in zip(BUCKETS, buckets):
+                running += n
+                out.append((name, name + "_bucket",
+                            labels + (("le", bound),), running))
+            out.append((name, name + "_bucket",
+                        labels + (("le", float("inf")),), count))
+            out.append((name, name + "_sum", labels, total))
+            out.append((name, name + "_count", labels, count))
+        for collect in self.collectors:
+            for name, labels, value in collect():
+                out.append((name, name, _labels(labels), value))
+        return out
+
+    def render(self):
+        by_metric = {}
+        for metric, series, labels, value in self.samples():
+            by_metric.setdefault(metric, []).append((series, labels, value))
+
+        lines = []
+        for metric in sorted(by_metric):
+            full = self.prefix + metric
+            lines.append("# HELP {0} {1}".format(full, self.help[metric]))
+            lines.append("# TYPE {0} {1}".format(full, self.kinds[metric]))
+            for series, labels, value in by_metric[metric]:
+                lines.append("{0}{1} {2}".format(self.prefix + series,
+                                                 _format_labels(labels),
+                                                 _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+class _Timer(object):
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, time.time() - self.start,
+                              **self.labels)
+
+def instrument_engine(registry, engine):
+    """Time every statement engine runs, by kind (SELECT, INSERT, ...)."""
+    import sqlalchemy.event
+
+    registry.describe("db_query_seconds", "histogram",
+                      "Time spent executing database statements.")
+
+    # the execution context is per statement, whereas connections can be
+    # shared between threads (in-memory SQLite uses a single one)
+    @sqlalchemy.event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        context.metrics_start = time.time()
+
+    @sqlalchemy.event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "metrics_start", None)
+        if start is None:
+            return
+        kind = statement.lstrip().split(None, 1)[0].upper() if statement else ""
+        registry.observe("db_query_seconds", time.time() - start,
+                         statement=kind)
+
+def cache_samples(name, stats):
+    """Samples for a cache.LRUCache or SegmentedCache stats() dict. A
+       cached "no such record" counts as a hit."""
+    hits = stats.get("hits", 0) + stats.get("negative_hits", 0)
+    misses = stats.get("misses", 0)
+    labels = {"cache": name}
+    samples = [
+        ("cache_entries", labels, stats["size"]),
+        ("cache_hits_total", labels, hits),
+        ("cache_misses_total", labels, misses),
+        ("cache_evictions_total", labels, stats.get("evictions", 0)),
+        ("cache_hit_ratio", labels,
+         float(hits) / (hits + misses) if hits + misses else 0.0),
+    ]
+    if "weight" in stats:
+        samples.append(("cache_weight", labels, stats["weight"]))
+    return samples
+
+def describe_caches(registry):
+    registry.describe("cache_entries", "gauge", "Entries held by each cache.")
+    registry.describe("cache_weight", "gauge",
+                      "Total weight (bytes, where weighed) of each cache.")
+    registry.describe("cache_hits_total", "counter", "Cache hits.")
+    registry.describe("cache_misses_total", "counter", "Cache misses.")
+    registry.describe("cache_evictions_total", "counter",
+                      "Entries evicted to make room.")
+    registry.describe("cache_hit_ratio", "gauge",
+                      "Hits over lookups since the worker started.")
@@ -0,0 +1,83 @@
+"""
+* migrations.py
+* Further licensing information: see LICENSE.
+"""
+import sys
+import json
+import datetime
+import sqlalchemy
+from sqlalchemy import Integer, DateTime, Unicode, Column, MetaData, Table
+
+"""
+Module summary: versioned schema changes, applied in order at startup or
+from the command line:
+
+    python3 src/migrations.py [status|upgrade]
+
+Append new steps to MIGRATIONS; never edit or reorder released ones.
+Statements must be safe to run against a database that create_all has
+just built from the current models, hence IF NOT EXISTS everywhere.
+"""
+
+MIGRATIONS = [
+    (1, "index the /friends listing and searchable counts",
+     ["CREATE INDEX IF NOT EXISTS ix_records_listing "
+      "ON records (timestamp, user_id) WHERE privacy > 0",
+      "CREATE INDEX IF NOT EXISTS ix_records_privacy ON records (privacy)"]),
+    (2, "index record_events for pruning",
+     ["CREATE INDEX IF NOT EXISTS ix_record_events_timestamp "
+      "ON record_events (timestamp)"]),
+]
+
+META = MetaData()
+SCHEMA_VERSION = Table("schema_version", META,
+    Column("version", Integer, primary_key=True),
+    Column("description", Unicode),
+    Column("applied", DateTime),
+)
+
+def current_version(engine):
+    SCHEMA_VERSION.create(engine, checkfirst=True)
+    with engine.connect() as conn:
+        return conn.execute(
+            sqlalchemy.select([sqlalchemy.func.max(SCHEMA_VERSION.c.version)])
+        ).scalar() or 0
+
+def pending(engine):
+    version = current_version(engine)
+    return [m for m in MIGRATIONS if m[0] > version]
+
+def upgrade(engine, log=None):
+    """Apply every pending migration, each in its own transaction.
+       Returns the list of versions applied."""
+    applied = []
+    for version, description, statements in pending(engine):
+        with engine.begin() as conn:
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(SCHEMA_VERSION.insert().values(
+                version=version, description=description,
+                applied=datetime.datetime.now()))
+        if log:
+            log("schema: applied {0} ({1})".format(version, description))
+        applied.append(version)
+    return applied
+
+if __name__ == "__main__":
+    import database
+
+    with open("config.json", "r") as config_file:
+        cfg = json.load(config_file)
+    command = sys.argv[1] if len(sys.argv) > 1 else "status"
+    engine = sqlalchemy.create_engine(cfg["database_url"])
+    if command == "upgrade":
+        database.BASE.metadata.create_all(engine)
+        upgrade(engine, log=print)
+        print("Schema is at version {0}.".format(current_version(engine)))
+    elif command == "status":
+        print("Schema is at version {0}.".format(current_version(engine)))
+        for version, description, _ in pending(engine):
+            print("pending: {0} ({1})".format(version, description))
+    else:
+        print("usage: migrations.py [status|upgrade]")
+        sys.exit(1)
@@ -0,0 +1,73 @@
+"""
+* ratelimit.py
+* Further licensing information: see LICENSE.
+"""
+import time
+from collections import OrderedDict
+
+"""
+Module summary: per-address token buckets with a fixed memory ceiling.
+"""
+
+class RateLimiter(object):
+    """Token buckets keyed by (budget, address). Each budget is a
+       (limit, period) pair: an address may spend limit tokens at once,
+       and gets them back at limit/period per second.
+
+       At most capacity addresses are tracked per budget; past that the
+       least recently seen one is forgotten, which only ever errs towards
+       letting it through. sweep() drops buckets that have refilled, so
+       idle addresses don't sit in memory until they are pushed out.
+
+       Only used from the IOLoop, so there is no locking."""
+    def __init__(self, budgets, capacity):
+        self.budgets = dict(budgets)
+        self.capacity = capacity
+        # address -> (tokens, last update), least recently used first
+        self.buckets = {budget: OrderedDict() for budget in self.budgets}
+        self.rejects = {budget: 0 for budget in self.budgets}
+        self.evictions = 0
+
+    def allow(self, budget, address, cost=1):
+        """Spend cost tokens from address's bucket. Returns 0, and counts
+           a reject, when it can't afford them."""
+        limit, period = self.budgets[budget]
+        buckets = self.buckets[budget]
+        now = time.time()
+        tokens, updated = buckets.pop(address, (limit, now))
+        tokens = min(limit, tokens + (now - updated) * limit / period)
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+        else:
+            self.rejects[budget] += 1
+        buckets[address] = (tokens, now)
+        while len(buckets) > self.capacity:
+            buckets.popitem(last=False)
+            self.evictions += 1
+        return allowed
+
+    def sweep(self):
+        """Forget every address that hasn't been seen for a whole period;
+           its bucket is full again, the same as a new one."""
+        now = time.time()
+        for budget, buckets in self.buckets.items():
+            horizon = now - self.budgets[budget][1]
+            while buckets:
+                address, (_, updated) = next(iter(buckets.items()))
+                if updated > horizon:
+                    break
+                del buckets[address]
+
+    def __len__(self):
+        return sum(len(buckets) for buckets in self.buckets.values())
+
+    def stats(self):
+        return {
+            budget: {
+                "size": len(self.buckets[budget]),
+                "rejects": self.rejects[budget],
+                "limit": limit,
+                "period": period,
+            } for budget, (limit, period) in self.budgets.items()
+        }
@@ -0,0 +1,236 @@
+"""
+* records_io.py
+* Further licensing information: see LICENSE.
+"""
+import os
+import sys
+import io
+import re
+import json
+import gzip
+import bz2
+import lzma
+import time
+import argparse
+import binascii
+import datetime
+import sqlalchemy
+import sqlalchemy.exc
+
+import database
+from main import (CryptoCore, VALID_KEY, DISALLOWED_CHARS, NAME_LIMIT_HARD,
+                  BIO_LIMIT)
+
+"""
+Module summary: copies the records table to and from newline-delimited
+JSON, one record per line, in fixed-size batches so memory stays flat
+whatever the table size. Run from the directory holding config.json (and,
+for imports, the server's key file):
+
+    python3 src/records_io.py export [-o records.ndjson.gz]
+    python3 src/records_io.py import records.ndjson.gz [--keep-signatures]
+
+Files ending in .gz, .bz2 or .xz are compressed; - is stdin/stdout.
+Imports are meant for a stopped server: running workers won't see the new
+records until they restart.
+"""
+
+BATCH_SIZE = 5000
+FIELDS = ("name", "bio", "public_key", "checksum", "pin", "privacy",
+          "timestamp", "sig", "password")
+OPENERS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+VALID_PIN = re.compile(r"^[A-Fa-f0-9]{8}$")
+
+class InvalidRecord(ValueError):
+    pass
+
+def open_stream(path, mode):
+    """path opened in text mode ("r" or "w"), compressed by extension."""
+    if path == "-":
+        stream = sys.stdin if mode == "r" else sys.stdout
+        return io.TextIOWrapper(stream.buffer, encoding="utf8")
+    for suffix, opener in OPENERS.items():
+        if path.endswith(suffix):
+            return opener(path, mode + "t", encoding="utf8")
+    return open(path, mode, encoding="utf8")
+
+def batches(engine, size=BATCH_SIZE):
+    """Every record, size rows at a time in user_id order. Each batch is a
+       separate short read, so no transaction stays open across the
+       table the way iterate_all_users' session does."""
+    table = database.User.__table__
+    last = 0
+    while True:
+        with engine.connect() as conn:
+            rows = conn.execute(table.select()
+                                .where(table.c.user_id > last)
+                                .order_by(table.c.user_id)
+                                .limit(size)).fetchall()
+        if not rows:
+            return
+        yield rows
+        last = rows[-1]["user_id"]
+
+def encode(row):
+    record = {field: row[field] for field in FIELDS}
+    record["timestamp"] = row["timestamp"].isoformat()
+    record["password"] = binascii.hexlify(row["password"]).decode("ascii")
+    return json.dumps(record, ensure_ascii=False, sort_keys=True)
+
+def parse_timestamp(text):
+    for layout in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return datetime.datetime.strptime(text, layout)
+        except ValueError:
+            pass
+    raise InvalidRecord("bad timestamp")
+
+def decode(line, crypto_core, keep_signatures):
+    """The insertable form of one NDJSON line, and whether its signature
+       had to be replaced. Raises InvalidRecord."""
+    try:
+        record = json.loads(line)
+        name = record["name"]
+        public_key = record["public_key"].upper()
+        pin = (record.get("pin") or "").upper()
+        checksum = record["checksum"].upper()
+        bio = record.get("bio") or ""
+        privacy = int(record["privacy"])
+        password = binascii.unhexlify(record["password"])
+        sig = record.get("sig") or ""
+        timestamp = parse_timestamp(record["timestamp"])
+    except KeyError as e:
+        raise InvalidRecord("missing {0}".format(e))
+    except (ValueError, TypeError, AttributeError, binascii.Error) as e:
+        raise InvalidRecord(str(e) or e.__class__.__name__)
+
+    if (not isinstance(name, str) or not name or name != name.lower()
+            or len(name) > NAME_LIMIT_HARD
+            or not DISALLOWED_CHARS.isdisjoint(name)):
+        raise InvalidRecord("bad name")
+    if not isinstance(bio, str) or len(bio) > BIO_LIMIT:
+        raise InvalidRecord("bad bio")
+    if not VALID_KEY.match(public_key) or (pin and
+                                           not VALID_PIN.match(pin)):
+        raise InvalidRecord("bad Tox ID")
+    if CryptoCore.compute_checksum(public_key + pin) != checksum:
+        raise InvalidRecord("bad checksum")
+
+    resigned = 0
+    if not keep_signatures:
+        # Ed25519 is deterministic, so signing again is also the check
+        expected = crypto_core.sign_fields(name, public_key, pin or None,
+                                           checksum)
+        if expected != sig:
+            sig, resigned = expected, 1
+    return {
+        "name": name, "bio": bio, "public_key": public_key,
+        "checksum": checksum, "pin": pin or None, "privacy": privacy,
+        "timestamp": timestamp, "sig": sig, "password": password,
+    }, resigned
+
+def insert(engine, rows):
+    """Insert rows in one transaction. If that hits a duplicate, insert
+       them one by one instead. Returns the positions of the rows that
+       were skipped."""
+    table = database.User.__table__
+    try:
+        with engine.begin() as conn:
+            conn.execute(table.insert(), rows)
+        return []
+    except sqlalchemy.exc.IntegrityError:
+        skipped = []
+        for position, row in enumerate(rows):
+            try:
+                with engine.begin() as conn:
+                    conn.execute(table.insert(), row)
+            except sqlalchemy.exc.IntegrityError:
+                skipped.append(position)
+        return skipped
+
+def export_records(engine, stream, size=BATCH_SIZE):
+    count = 0
+    for rows in batches(engine, size):
+        stream.write("".join(encode(row) + "\n" for row in rows))
+        count += len(rows)
+    return count
+
+def import_records(engine, stream, crypto_core, keep_signatures=0,
+                   size=BATCH_SIZE, log=None):
+    """Returns a dict of imported, skipped (already present), rejected
+       and resigned counts. Only imported rows count as resigned."""
+    counts = {"imported": 0, "skipped": 0, "rejected": 0, "resigned": 0}
+    pending, flags = [], []
+
+    def flush():
+        skipped = insert(engine, pending)
+        counts["skipped"] += len(skipped)
+        counts["imported"] += len(pending) - len(skipped)
+        counts["resigned"] += sum(flags) - sum(flags[i] for i in skipped)
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row, resigned = decode(line, crypto_core, keep_signatures)
+        except InvalidRecord as e:
+            counts["rejected"] += 1
+            if log:
+                log("line {0}: {1}".format(number, e))
+            continue
+        pending.append(row)
+        flags.append(resigned)
+        if len(pending) == size:
+            flush()
+            pending, flags = [], []
+    if pending:
+        flush()
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Copy the records table to or from NDJSON.")
+    commands = parser.add_subparsers(dest="command")
+    exporter = commands.add_parser("export")
+    exporter.add_argument("-o", "--output", default="-")
+    importer = commands.add_parser("import")
+    importer.add_argument("input")
+    importer.add_argument("--keep-signatures", action="store_true",
+                          help="don't check or replace the record signatures")
+    for command in (exporter, importer):
+        command.add_argument("--batch", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+    if not args.command:
+        parser.print_usage()
+        sys.exit(1)
+
+    if (args.command == "import" and not args.keep_signatures
+            and not (os.path.isfile("key") and os.path.getsize("key"))):
+        # CryptoCore would make up a new key and sign everything with it
+        parser.error("no key file here to sign the records with; run from "
+                     "the server's directory or pass --keep-signatures")
+
+    with open("config.json", "r") as config_file:
+        cfg = json.load(config_file)
+    start = time.time()
+    if args.command == "export":
+        engine = sqlalchemy.create_engine(cfg["database_url"])
+        with open_stream(args.output, "w") as stream:
+            count = export_records(engine, stream, args.batch)
+        counts = {"exported": count}
+    else:
+        database.Database(cfg["database_url"], should_echo=0).create_schema()
+        engine = sqlalchemy.create_engine(cfg["database_url"])
+        crypto_core = None if args.keep_signatures else CryptoCore()
+        with open_stream(args.input, "r") as stream:
+            counts = import_records(engine, stream, crypto_core,
+                                    args.keep_signatures, args.batch,
+                                    log=lambda text: print(text,
+                                                           file=sys.stderr))
+    elapsed = max(time.time() - start, 1e-6)
+    rows = sum(counts.values()) - counts.get("resigned", 0)
+    print("{0} ({1:.0f} rows/min)".format(
+        ", ".join("{0} {1}".format(v, k) for k, v in counts.items()),
+        rows / elapsed * 60), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
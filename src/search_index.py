@@ -0,0 +1,92 @@
+"""
+* search_index.py
+* Further licensing information: see LICENSE.
+"""
+import threading
+import heapq
+from collections import defaultdict
+
+"""
+Module summary: an in-memory n-gram index over searchable user names.
+"""
+
+GRAM_LENGTH = 3
+
+def grams(text, n=GRAM_LENGTH):
+    """Every distinct n-character substring of text."""
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+class TrigramIndex(object):
+    """Maps lowercase trigrams to the set of names containing them.
+       Only searchable users are indexed; the caller decides that."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.postings = defaultdict(set)
+        self.names = set()
+
+    def clear(self):
+        with self.lock:
+            self.postings.clear()
+            self.names.clear()
+
+    def add(self, name):
+        key = name.lower()
+        with self.lock:
+            if key in self.names:
+                return
+            self.names.add(key)
+            for gram in grams(key):
+                self.postings[gram].add(key)
+
+    def discard(self, name):
+        key = name.lower()
+        with self.lock:
+            if key not in self.names:
+                return
+            self.names.discard(key)
+            for gram in grams(key):
+                posting = self.postings.get(gram)
+                if posting is None:
+                    continue
+                posting.discard(key)
+                if not posting:
+                    del self.postings[gram]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name.lower() in self.names
+
+    def _candidates(self, query):
+        postings = []
+        for gram in grams(query):
+            posting = self.postings.get(gram)
+            if not posting:
+                return set()
+            postings.append(posting)
+        # intersect starting from the rarest gram so the working set
+        # never grows past the smallest posting list
+        postings.sort(key=len)
+        result = set(postings[0])
+        for posting in postings[1:]:
+            result &= posting
+            if not result:
+                break
+        return result
+
+    def search(self, query, offset, limit):
+        """Names containing query in name order, sliced to
+           [offset:offset + limit]."""
+        query = query.lower()
+        if limit <= 0 or offset < 0:
+            return []
+        with self.lock:
+            if len(query) < GRAM_LENGTH:
+                # too short to have a trigram: walk the names instead
+                pool = self.names
+            else:
+                pool = self._candidates(query)
+            matches = (name for name in pool if query in name)
+            page = heapq.nsmallest(offset + limit, matches)
+        return page[offset:]
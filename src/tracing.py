@@ -0,0 +1,176 @@
+"""
+* tracing.py
+* Further licensing information: see LICENSE.
+"""
+import os
+import sys
+import time
+import atexit
+import threading
+import functools
+from collections import Counter
+
+import tornado.stack_context
+
+"""
+Module summary: request-scoped timing. While a request is handled, its
+Trace is "current": on the IOLoop thread that is carried through every
+callback and coroutine by a StackContext, and bind() hands it to the
+database threads. Instrumented code adds the time it spends to the
+current trace under a phase name (sql, db, crypto, qr, render, json), so a
+slow request can be logged with where its time went.
+
+Also home to SamplingProfiler, which records what every thread is doing
+at a fixed interval and writes the totals as folded stacks.
+"""
+
+LOCAL = threading.local()
+
+class Trace(object):
+    """Time spent in each phase of one request. Phases can overlap (a
+       db call includes its sql, and calls may run in parallel), so they
+       don't add up to the request's total."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        # phase -> [calls, seconds]
+        self.phases = {}
+
+    def add(self, phase, seconds):
+        with self.lock:
+            totals = self.phases.get(phase)
+            if totals is None:
+                totals = self.phases[phase] = [0, 0.0]
+            totals[0] += 1
+            totals[1] += seconds
+
+    def breakdown(self):
+        with self.lock:
+            return {phase: {"count": calls, "ms": round(seconds * 1000, 2)}
+                    for phase, (calls, seconds) in self.phases.items()}
+
+class _Active(object):
+    def __init__(self, trace):
+        self.trace = trace
+
+    def __enter__(self):
+        self.previous = getattr(LOCAL, "trace", None)
+        LOCAL.trace = self.trace
+
+    def __exit__(self, *exc):
+        LOCAL.trace = self.previous
+
+def current():
+    return getattr(LOCAL, "trace", None)
+
+def activate(trace):
+    """A StackContext that makes trace current for everything run from
+       inside it, now or in later callbacks."""
+    return tornado.stack_context.StackContext(functools.partial(_Active,
+                                                                trace))
+
+def traced(application):
+    """Wrap an HTTPServer request callback so each request gets a Trace,
+       left on request.trace for whoever logs the request."""
+    def handle(request):
+        request.trace = Trace()
+        with activate(request.trace):
+            application(request)
+    return handle
+
+class phase(object):
+    """Adds the time its block takes to the current trace, if any."""
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.trace = current()
+        if self.trace is not None:
+            self.start = time.time()
+
+    def __exit__(self, *exc):
+        if self.trace is not None:
+            self.trace.add(self.name, time.time() - self.start)
+
+def bind(fn, name):
+    """fn, made to run with the current trace in whichever thread calls
+       it, adding its time (queueing included) under name."""
+    trace = current()
+    if trace is None:
+        return fn
+    start = time.time()
+    @functools.wraps(fn)
+    def run(*args):
+        LOCAL.trace = trace
+        try:
+            return fn(*args)
+        finally:
+            LOCAL.trace = None
+            trace.add(name, time.time() - start)
+    return run
+
+def instrument_engine(engine):
+    """Count every statement engine runs, and its time, as sql."""
+    import sqlalchemy.event
+
+    @sqlalchemy.event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        context.trace_start = time.time()
+
+    @sqlalchemy.event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        trace = current()
+        if trace is not None:
+            trace.add("sql", time.time() - context.trace_start)
+
+class SamplingProfiler(object):
+    """Samples the stack of every thread in this process each interval
+       seconds. write() saves the counts so far to path in the folded
+       format flamegraph.pl and speedscope read: one line per distinct
+       stack, outermost frame (the thread name) first, then the count."""
+    def __init__(self, interval, path, write_every=10):
+        self.interval = interval
+        self.path = path
+        self.write_every = write_every
+        self.stacks = Counter()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True,
+                                       name="sampling-profiler")
+        self.thread.start()
+        atexit.register(self.write)
+
+    def _run(self):
+        me = threading.get_ident()
+        last_write = time.time()
+        while 1:
+            time.sleep(self.interval)
+            names = {t.ident: t.name for t in threading.enumerate()}
+            sample = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{0}:{1}".format(
+                        os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                sample.append(";".join(reversed(stack)))
+            with self.lock:
+                self.stacks.update(sample)
+            if time.time() - last_write >= self.write_every:
+                self.write()
+                last_write = time.time()
+
+    def write(self):
+        with self.lock:
+            lines = ["{0} {1}\n".format(stack, count)
+                     for stack, count in self.stacks.items()]
+        # written whole and swapped in, so readers never see half a file
+        partial = self.path + ".tmp"
+        with open(partial, "w") as output:
+            output.writelines(lines)
+        os.replace(partial, self.path)